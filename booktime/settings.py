@@ -37,6 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'webpack_loader',
     'django_extensions',
     'debug_toolbar',
@@ -109,6 +110,24 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+# The page cache and the catalog lists are expired by whichever
+# process handles a change, so they are only turned on with a cache
+# that every process shares. Without memcached, each process gets its
+# own local memory cache and they stay off.
+if os.getenv('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.getenv('MEMCACHED_LOCATION'),
+        }
+    }
+    SHARED_CACHE = True
+else:
+    SHARED_CACHE = False
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 AUTH_USER_MODEL = "main.User"
@@ -178,6 +197,10 @@ LOGGING = {
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Renditions made on demand by the image_rendition view
+RENDITION_CACHE_ROOT = os.path.join(BASE_DIR, 'rendition-cache')
+RENDITION_CACHE_MAX_SIZE = 512 * 1024 * 1024
+
 if not DEBUG:
     EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
     EMAIL_HOST_USER = "username"
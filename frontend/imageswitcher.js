@@ -2,6 +2,9 @@ const React = require("react");
 const ReactDOM = require("react-dom");
 const e = React.createElement;
 
+// Browsers pick the smallest rendition of the srcsets that fills this
+var currentImageSizes = "(max-width: 600px) 100vw, 600px";
+
 var imageStyle = {
     margin: "10px",
     display: "inline-block"
@@ -28,13 +31,25 @@ class ImageBox extends React.Component {
                 },
                 e('img', {
                     onClick: this.click.bind(this, i),
-                    width: "100", src: i.thumbnail
+                    width: "100", src: i.thumbnail,
+                    srcSet: i.srcset || undefined,
+                    sizes: "100px"
                 })
             )
         );
+        const current = this.state.currentImage;
         return e('div', {className: "gallery"},
-            e('div', {className: "current-image"},
-                e('img', {src: this.state.currentImage.image})
+            e('picture', {className: "current-image"},
+                current.webp_srcset ? e('source', {
+                    type: "image/webp",
+                    srcSet: current.webp_srcset,
+                    sizes: currentImageSizes
+                }) : null,
+                e('img', {
+                    src: current.image,
+                    srcSet: current.srcset || undefined,
+                    sizes: currentImageSizes
+                })
             ),
             images)
     }
@@ -30,3 +30,26 @@ test('ImageBox switches iamge correctly', ()=>{
 
     expect(currentImage).not.toEqual(newImage);
 });
+
+test('ImageBox passes srcsets to the browser', ()=>{
+    var images = [
+        {
+            "image":"1.jpg",
+            "thumbnail":"1.thumb.jpg",
+            "srcset":"1-150.jpeg 150w, 1-300.jpeg 300w",
+            "webp_srcset":"1-150.webp 150w, 1-300.webp 300w"
+        }
+    ];
+    const wrapper = Enzyme.shallow(
+        React.createElement(ImageBox, {images:images, imageStart: images[0]})
+    );
+    expect(
+        wrapper.find('.current-image > source').first().prop('srcSet')
+    ).toEqual(images[0].webp_srcset);
+    expect(
+        wrapper.find('.current-image > img').first().prop('srcSet')
+    ).toEqual(images[0].srcset);
+    expect(
+        wrapper.find('div.image img').first().prop('srcSet')
+    ).toEqual(images[0].srcset);
+});
@@ -1,4 +1,4 @@
-from . import models
+from . import catalog, models, pagecache
 from django.utils.html import format_html
 from datetime import datetime, timedelta
 import logging
@@ -20,6 +20,8 @@ logger = logging.getLogger(__name__)
 
 def make_active(self, request, queryset):
     queryset.update(active=True)
+    if queryset.model is models.Product:
+        pagecache.purge_products(*catalog.listed_in(queryset))
 
 
 make_active.short_description = "Mark selected items as active"
@@ -27,6 +29,8 @@ make_active.short_description = "Mark selected items as active"
 
 def make_inactive(self, request, queryset):
     queryset.update(active=False)
+    if queryset.model is models.Product:
+        pagecache.purge_products(*catalog.listed_in(queryset))
 
 
 make_inactive.short_description = (
@@ -225,6 +229,10 @@ class BasketAdmin(admin.ModelAdmin):
     list_filter = ("status",)
     inlines = (BasketLineInline,)
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.refresh_item_count()
+
 
 class OrderLineInline(admin.TabularInline):
     model = models.OrderLine
@@ -0,0 +1,88 @@
+import logging
+from django.db import transaction
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+class SessionBasket:
+    """
+    Basket of an anonymous visitor, stored in the session as a mapping
+    of product ids to quantities. It is only written to the database
+    when the visitor logs in or checks out.
+    """
+
+    SESSION_KEY = "basket"
+    id = None
+
+    def __init__(self, session):
+        self.session = session
+        self.quantities = session.setdefault(self.SESSION_KEY, {})
+
+    def is_empty(self):
+        return self.count() == 0
+
+    def count(self):
+        return sum(self.quantities.values())
+
+    @property
+    def item_count(self):
+        return self.count()
+
+    def add_product(self, product, quantity=1):
+        key = str(product.id)
+        self.quantities[key] = self.quantities.get(key, 0) + quantity
+        self.session.modified = True
+        return models.BasketLine(
+            product=product, quantity=self.quantities[key]
+        )
+
+    def set_quantity(self, product_id, quantity):
+        key = str(product_id)
+        if quantity:
+            self.quantities[key] = quantity
+        else:
+            self.quantities.pop(key, None)
+        self.session.modified = True
+
+    def get_lines(self):
+        """Unsaved BasketLine instances for the products still around."""
+        products = models.Product.objects.in_bulk(
+            [int(key) for key in self.quantities]
+        )
+        return [
+            models.BasketLine(
+                product=products[int(key)], quantity=quantity
+            )
+            for key, quantity in self.quantities.items()
+            if int(key) in products
+        ]
+
+    def save_to_db(self, user):
+        """
+        Write the lines into the open basket of user, creating it if
+        needed, and make that basket the one of the session.
+        """
+        quantities = {
+            line.product_id: line.quantity for line in self.get_lines()
+        }
+        with transaction.atomic():
+            basket = (
+                models.Basket.objects.filter(
+                    user=user, status=models.Basket.OPEN
+                )
+                .order_by("id")
+                .first()
+            )
+            if basket is None:
+                basket = models.Basket.objects.create(user=user)
+            if quantities:
+                models.BasketLine.objects.add_products(basket, quantities)
+        del self.session[self.SESSION_KEY]
+        self.session["basket_id"] = basket.id
+        logger.info(
+            "Saved session basket with %d items to basket id %d",
+            sum(quantities.values()),
+            basket.id,
+        )
+        return basket
@@ -0,0 +1,116 @@
+from bisect import bisect_left, bisect_right
+from django.core.cache import cache
+from django.utils import timezone
+from . import pagecache
+from .models import Product, ProductTag
+from .pagination import KeysetPage, KeysetPaginator
+
+ALL = "all"
+
+# Lists are cached under the page cache version of their catalog tag,
+# which the receivers in main.signals replace whenever a list changes:
+# the next read builds the list again. A list built from data older
+# than the change is stored under the old version and never read.
+CATALOG_TIMEOUT = 60 * 60
+
+# Columns shown by main/product_list.html
+LISTING_FIELDS = ("id", "name", "slug")
+
+
+def cache_key(tag):
+    version, = pagecache.get_versions([pagecache.catalog_tag(tag)]).values()
+    return "catalog:%s:%s" % (tag, version)
+
+
+def build_entries(tag):
+    """
+    Sorted (name, id) pairs of the active products under tag, or None
+    if there is no such tag. Sorting happens in Python, so that pages
+    can be found in the lists with bisect.
+    """
+    products = Product.objects.active()
+    if tag != ALL:
+        if not ProductTag.objects.filter(slug=tag).exists():
+            return None
+        products = products.filter(tags__slug=tag)
+    return sorted(products.values_list("name", "id"))
+
+
+def get_listing(tag):
+    """
+    The (updated, entries) of tag, or None if there is no such tag.
+    updated is when the list was built, which is after its last
+    change, so that pages can be validated without a query.
+    """
+    if not pagecache.enabled():
+        entries = build_entries(tag)
+        return None if entries is None else (timezone.now(), entries)
+    key = cache_key(tag)
+    listing = cache.get(key)
+    if listing is None:
+        entries = build_entries(tag)
+        if entries is None:
+            return None
+        listing = (timezone.now(), entries)
+        cache.set(key, listing, CATALOG_TIMEOUT)
+    return listing
+
+
+def get_entries(tag):
+    listing = get_listing(tag)
+    return None if listing is None else listing[1]
+
+
+def listed_in(products):
+    """
+    The products, e.g. after update(), and the slugs of the tags they
+    are listed under, for pagecache.purge_products().
+    """
+    products = list(
+        products.only("id", "slug").prefetch_related("tags")
+    )
+    tags = {tag.slug for product in products for tag in product.tags.all()}
+    return products, sorted(tags)
+
+
+class CatalogPaginator(KeysetPaginator):
+    """
+    KeysetPaginator over a cached list of (name, id) pairs. A page is
+    found by bisecting the list, and only its rows are fetched, by
+    primary key.
+    """
+
+    def __init__(self, entries, per_page):
+        super().__init__(
+            Product.objects.only(*LISTING_FIELDS), ("name", "id"), per_page
+        )
+        self.entries = entries
+
+    def page(self, cursor=None):
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+        else:
+            direction, values = "n", None
+
+        if direction == "n":
+            start = 0
+            if values is not None:
+                start = bisect_right(self.entries, tuple(values))
+            window = self.entries[start:start + self.per_page + 1]
+            more = len(window) > self.per_page
+            window = window[:self.per_page]
+        else:
+            end = bisect_left(self.entries, tuple(values))
+            start = max(end - self.per_page, 0)
+            window = self.entries[start:end]
+            more = start > 0
+
+        products = self.queryset.in_bulk([pk for _, pk in window])
+        # Rows deleted since the list was cached are skipped
+        rows = [products[pk] for _, pk in window if pk in products]
+        if direction == "n":
+            return KeysetPage(rows, self, more, values is not None)
+        return KeysetPage(rows, self, True, more)
+
+    def estimated_count(self):
+        return len(self.entries)
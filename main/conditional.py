@@ -0,0 +1,60 @@
+import calendar
+import hashlib
+from functools import partial
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+
+def make_etag(*parts):
+    return hashlib.md5(repr(parts).encode()).hexdigest()
+
+
+def page_state(request):
+    """
+    What pages show about the visitor besides the content itself: the
+    basket count in the navigation bar depends on it.
+    """
+    basket = request.basket_summary
+    return (request.user.pk, basket.id, basket.count())
+
+
+def conditional_response(request, etag, last_modified, respond):
+    """
+    Answer 304 (or 412) when the request preconditions match etag and
+    last_modified, without calling respond(). Otherwise respond() makes
+    the response, which gets both validators.
+    """
+    etag = quote_etag(etag) if etag else None
+    timestamp = None
+    if last_modified:
+        timestamp = calendar.timegm(last_modified.utctimetuple())
+    response = get_conditional_response(
+        request, etag=etag, last_modified=timestamp
+    )
+    if response is None:
+        response = respond()
+    if response.status_code in (200, 304):
+        if etag and not response.has_header("ETag"):
+            response["ETag"] = etag
+        if timestamp and not response.has_header("Last-Modified"):
+            response["Last-Modified"] = http_date(timestamp)
+    return response
+
+
+class ConditionalGetMixin:
+    """
+    For class-based views: get_validators() returns the ETag and the
+    Last-Modified datetime of the page, or Nones when it has neither.
+    """
+
+    def get_validators(self):
+        return None, None
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        return conditional_response(
+            request,
+            etag,
+            last_modified,
+            partial(super().get, request, *args, **kwargs),
+        )
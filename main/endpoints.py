@@ -1,5 +1,77 @@
-from rest_framework import serializers, viewsets
+from functools import partial
+from django.db import transaction
+from rest_framework import mixins, permissions, serializers, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
 from . import models
+from .conditional import conditional_response, make_etag
+from .pagination import KeysetPagination
+from .search import format_headline
+
+
+class ChangeModelPermissions(permissions.DjangoModelPermissions):
+    # Bulk actions are POSTed but only change existing rows
+    perms_map = dict(
+        permissions.DjangoModelPermissions.perms_map,
+        POST=["%(app_label)s.change_%(model_name)s"],
+    )
+
+
+class ConditionalViewSetMixin:
+    """
+    Answers conditional GETs on list and retrieve from the
+    validator_fields dates of the rows in the response, before any row
+    is serialized.
+    Lists only look at the rows of the requested page, never at the
+    whole feed.
+    """
+
+    validator_fields = ("date_updated",)
+
+    def get_validators(self, queryset, *parts):
+        rows = list(
+            queryset.order_by("pk").values_list("pk", *self.validator_fields)
+        )
+        if not rows:
+            return None, None
+        dates = [date for row in rows for date in row[1:] if date]
+        etag = make_etag(rows, parts, self.request.accepted_media_type)
+        return etag, max(dates) if dates else None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is None:
+            return conditional_response(
+                request,
+                *self.get_validators(queryset),
+                partial(super().list, request, *args, **kwargs)
+            )
+        keyset_page = self.paginator.page
+        # The cursors change when rows are added or removed around the
+        # page, even if its own rows did not.
+        validators = self.get_validators(
+            queryset.filter(pk__in=[obj.pk for obj in page]),
+            keyset_page.next_cursor,
+            keyset_page.previous_cursor,
+        )
+        return conditional_response(
+            request, *validators, partial(self.respond_page, page)
+        )
+
+    def respond_page(self, page):
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).filter(
+            pk=kwargs[self.lookup_url_kwarg or self.lookup_field]
+        )
+        return conditional_response(
+            request,
+            *self.get_validators(queryset),
+            partial(super().retrieve, request, *args, **kwargs)
+        )
 
 
 class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
@@ -11,12 +83,48 @@ class OrderLineSerializer(serializers.HyperlinkedModelSerializer):
         read_only_fields = ('id', 'order', 'product')
 
 
-class PaidOrderLineViewSet(viewsets.ModelViewSet):
+class OrderLineTransitionSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(),
+        allow_empty=False,
+        max_length=1000,
+    )
+    status = serializers.ChoiceField(choices=models.OrderLine.STATUSES)
+
+
+class PaidOrderLineViewSet(ConditionalViewSetMixin, viewsets.ModelViewSet):
     queryset = models.OrderLine.objects.filter(
         order__status=models.Order.PAID
-    ).order_by("-order__date_added")
+    ).select_related("order").order_by("-order__date_added")
     serializer_class = OrderLineSerializer
     filter_fields = ('order', 'status')
+    pagination_class = KeysetPagination
+    keyset_ordering = ("-order__date_added", "-id")
+    # Line changes move the date of their order
+    validator_fields = ("order__date_updated", "product__date_updated")
+
+    @action(
+        detail=False,
+        methods=["post"],
+        permission_classes=[ChangeModelPermissions],
+        serializer_class=OrderLineTransitionSerializer,
+    )
+    def transition(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        ids = set(serializer.validated_data["ids"])
+        status = serializer.validated_data["status"]
+        with transaction.atomic():
+            lines = self.get_queryset().filter(id__in=ids)
+            try:
+                matched = lines.set_status(status)
+            except ValueError as e:
+                raise serializers.ValidationError({"status": [str(e)]})
+            if matched != len(ids):
+                raise serializers.ValidationError(
+                    {"ids": ["Some lines do not exist or are not paid"]}
+                )
+        return Response({"updated": matched, "status": status})
 
 
 class OrderSerializer(serializers.HyperlinkedModelSerializer):
@@ -34,9 +142,36 @@ class OrderSerializer(serializers.HyperlinkedModelSerializer):
             )
 
 
-class PaidOrderViewSet(viewsets.ModelViewSet):
+class PaidOrderViewSet(ConditionalViewSetMixin, viewsets.ModelViewSet):
     queryset = models.Order.objects.filter(
         status=models.Order.PAID
     ).order_by("-date_added")
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
+    keyset_ordering = ("-date_added", "-id")
+
+
+
+class ProductSearchSerializer(serializers.ModelSerializer):
+    rank = serializers.FloatField()
+    headline = serializers.SerializerMethodField()
+
+    class Meta:
+        model = models.Product
+        fields = ('id', 'name', 'slug', 'price', 'rank', 'headline')
+
+    def get_headline(self, obj):
+        return format_headline(obj.headline)
+
+
+class ProductSearchViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
+    queryset = models.Product.objects.none()
+    serializer_class = ProductSearchSerializer
+    permission_classes = (permissions.AllowAny,)
+    filter_backends = ()
 
+    def get_queryset(self):
+        query = self.request.query_params.get("q", "").strip()
+        if not query:
+            return models.Product.objects.none()
+        return models.Product.objects.search(query)
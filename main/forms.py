@@ -4,7 +4,7 @@ from django.contrib.auth.forms import (
     UserCreationForm as DjangoUserCreationForm
 )
 from . import widgets
-from django.forms import inlineformset_factory
+from django.forms import BaseInlineFormSet, inlineformset_factory
 from django.contrib.auth import authenticate
 from django.contrib.auth.forms import UsernameField
 from . import models
@@ -85,15 +85,77 @@ class AuthenticationForm(forms.Form):
         return self.user
 
 
+class BaseBasketLineFormSet(BaseInlineFormSet):
+    def save(self, commit=True):
+        lines = super().save(commit)
+        if commit:
+            self.instance.refresh_item_count()
+        return lines
+
+
 BasketLineFormSet = inlineformset_factory(
     models.Basket,
     models.BasketLine,
+    formset=BaseBasketLineFormSet,
     fields=("quantity",),
     extra=0,
     widgets={"quantity": widgets.PlusMinusNumberInput()},
 )
 
 
+class SessionBasketLineForm(forms.Form):
+    product = forms.IntegerField(widget=forms.HiddenInput)
+    quantity = forms.IntegerField(
+        min_value=1, widget=widgets.PlusMinusNumberInput()
+    )
+
+
+class BaseSessionBasketLineFormSet(forms.BaseFormSet):
+    """
+    Counterpart of BasketLineFormSet for the lines of a SessionBasket.
+    """
+
+    def __init__(self, data=None, *args, instance, **kwargs):
+        self.instance = instance
+        self.lines = instance.get_lines()
+        kwargs["initial"] = [
+            {"product": line.product_id, "quantity": line.quantity}
+            for line in self.lines
+        ]
+        super().__init__(data, *args, **kwargs)
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if i < len(self.lines):
+            form.instance = self.lines[i]
+        return form
+
+    def save(self):
+        for form in self.forms:
+            if form in self.deleted_forms:
+                quantity = 0
+            else:
+                quantity = form.cleaned_data["quantity"]
+            self.instance.set_quantity(
+                form.cleaned_data["product"], quantity
+            )
+
+
+SessionBasketLineFormSet = forms.formset_factory(
+    SessionBasketLineForm,
+    formset=BaseSessionBasketLineFormSet,
+    extra=0,
+    can_delete=True,
+)
+
+
+class AddToBasketForm(forms.Form):
+    product = forms.ModelChoiceField(
+        queryset=models.Product.objects.active()
+    )
+    quantity = forms.IntegerField(min_value=1, required=False)
+
+
 class AddressSelectionForm(forms.Form):
     billing_address = forms.ModelChoiceField(
         queryset=None
@@ -0,0 +1,61 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from main import models
+from main.storage import media_storage
+
+DIRECTORIES = ("product-images", "product-thumbnails", "product-renditions")
+
+
+class Command(BaseCommand):
+    help = 'Delete product image files no row refers to'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age", type=int, default=3600,
+            help="Seconds a file must be old to be deleted, so that "
+                 "uploads not yet saved to the database are kept",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report what would be deleted",
+        )
+
+    def handle(self, *args, **options):
+        referenced = set()
+        for name in models.ProductImage.objects.values_list(
+            "image", "thumbnail"
+        ).iterator():
+            referenced.update(name)
+        referenced.update(
+            models.ProductImageRendition.objects.values_list(
+                "file", flat=True
+            ).iterator()
+        )
+        cutoff = time.time() - options["min_age"]
+        files = size = 0
+        for directory in DIRECTORIES:
+            for name in self.walk(directory):
+                if name in referenced:
+                    continue
+                path = media_storage.path(name)
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                files += 1
+                size += os.path.getsize(path)
+                if not options["dry_run"]:
+                    media_storage.delete(name)
+        self.stdout.write(
+            "%s files=%d bytes=%d"
+            % ("Would delete" if options["dry_run"] else "Deleted",
+               files, size)
+        )
+
+    def walk(self, directory):
+        if not media_storage.exists(directory):
+            return
+        directories, files = media_storage.listdir(directory)
+        for name in files:
+            yield "%s/%s" % (directory, name)
+        for subdirectory in directories:
+            yield from self.walk("%s/%s" % (directory, subdirectory))
@@ -1,12 +1,18 @@
 from django.core.management.base import BaseCommand
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import Future
+from decimal import Decimal
+from itertools import islice
 
 import csv
 import os.path
 from django.core.files.images import ImageFile
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.template.defaultfilters import slugify
-from main import models
+from django.utils import timezone
+from main import catalog, models, pagecache, thumbnails
+from main.storage import media_storage
 
 
 class Command(BaseCommand):
@@ -15,11 +21,44 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument("csvfile", type=open)
         parser.add_argument("image_basedir", type=str)
+        parser.add_argument(
+            "--bulk", action="store_true",
+            help="Write rows in bulk, one transaction per chunk",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=1000,
+            help="Rows per transaction with --bulk",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Processes storing and resizing images with --bulk; "
+                 "1 does it in this process",
+        )
 
     def handle(self, *args, **options):
         self.stdout.write("Importing products")
-        c = Counter()
         reader = csv.DictReader(options.pop("csvfile"))
+        if options["bulk"]:
+            c = BulkImport(options["image_basedir"]).run(
+                reader, options["chunk_size"], options["workers"]
+            )
+        else:
+            c = self.import_rows(reader, options["image_basedir"])
+        self.stdout.write(
+            "Products processed=%d (created=%d)"
+            % (c["products"], c["products_created"])
+        )
+        self.stdout.write(
+            "Tags processed=%d (created=%d)"
+            % (c["tags"], c["tags_created"])
+        )
+        self.stdout.write(
+            "Images processed=%d" % c["images"]
+        )
+
+    def import_rows(self, reader, image_basedir):
+        c = Counter()
+        image_field = models.ProductImage._meta.get_field("image")
         for row in reader:
             product, created = models.Product.objects.get_or_create(
                 name=row["name"], price=row["price"]
@@ -27,37 +66,247 @@ class Command(BaseCommand):
             product.description = row["description"]
             product.slug = slugify(row["name"])
             for import_tag in row["tags"].split("|"):
-                tag, tag_created = models.ProductTag.objects.get_or_create(
-                    name=import_tag
+                tag, tag_created = (
+                    models.ProductTag.objects.get_or_create_for_name(
+                        import_tag
+                    )
                 )
                 product.tags.add(tag)
                 c["tags"] += 1
                 if tag_created:
                     c["tags_created"] += 1
             with open(
-                os.path.join(options["image_basedir"],
-                             row["image_filename"]),
+                os.path.join(image_basedir, row["image_filename"]),
                 "rb",
             ) as f:
-                image = models.ProductImage(
-                    product=product,
-                    image=ImageFile(f, name=row["image_filename"]),
+                image_file = ImageFile(f, name=row["image_filename"])
+                # Files are stored by content hash, so a re-imported
+                # image already has a row with the same name.
+                name = media_storage.content_name(
+                    image_field.generate_filename(None, image_file.name),
+                    image_file,
                 )
-                image.save()
+                if not product.productimage_set.filter(image=name).exists():
+                    image = models.ProductImage(
+                        product=product, image=image_file
+                    )
+                    image.save()
                 c["images"] += 1
 
             product.save()
             c["products"] += 1
             if created:
                 c["products_created"] += 1
-        self.stdout.write(
-            "Products processed=%d (created=%d)"
-            % (c["products"], c["products_created"])
+        return c
+
+
+class BulkImport:
+    """
+    Imports rows a chunk at a time, with a handful of statements per
+    chunk whatever its size. Products, tags and images already in the
+    database are loaded once into the maps below.
+
+    CSV parsing and database writes happen in this process, while the
+    images of the rows are stored and resized by a pool of workers.
+    The images of a chunk are submitted as soon as it is read, so the
+    workers resize one chunk while the previous one is written.
+
+    Bulk writes skip the save() signals, so what their receivers
+    maintain is done here for each chunk: search vectors, catalog
+    lists, page cache purges and thumbnails.
+    """
+
+    # Chunks submitted to the workers ahead of the one being written.
+    # Reading stops until they catch up, which bounds memory.
+    PREFETCH = 1
+
+    def __init__(self, image_basedir):
+        self.image_basedir = image_basedir
+        self.counter = Counter()
+        # get_or_create() in the row by row import matches on these;
+        # when several rows match, the oldest wins.
+        self.products = {}
+        for product in models.Product.objects.only(
+            "id", "name", "price"
+        ).order_by("id"):
+            self.products.setdefault((product.name, product.price), product)
+        # Tags are matched like get_or_create_for_name() does: by name,
+        # or else by slug.
+        self.tags = {}
+        self.tag_slugs = {}
+        for tag in models.ProductTag.objects.only(
+            "id", "name", "slug"
+        ).order_by("id"):
+            self.tags.setdefault(tag.name, tag)
+            self.tag_slugs[tag.slug] = tag
+        self.images = set()
+        # The thumbnail and (width, format, file) renditions of each
+        # file already rendered, from the oldest image of it, which
+        # new images of the same file share.
+        self.rendered = {}
+        sources = {}
+        for pk, product_id, image, thumbnail in (
+            models.ProductImage.objects.values_list(
+                "pk", "product_id", "image", "thumbnail"
+            ).order_by("id")
+        ):
+            self.images.add((product_id, image))
+            if thumbnail and image not in self.rendered:
+                self.rendered[image] = (thumbnail, [])
+                sources[pk] = image
+        for image_id, width, format, file in (
+            models.ProductImageRendition.objects.values_list(
+                "image_id", "width", "format", "file"
+            )
+        ):
+            if image_id in sources:
+                self.rendered[sources[image_id]][1].append(
+                    (width, format, file)
+                )
+        self.pool = None
+
+    def run(self, reader, chunk_size, workers=1):
+        self.pool = thumbnails.worker_pool(
+            workers,
+            initializer=thumbnails.set_rendered_images,
+            initargs=(set(self.rendered),),
         )
-        self.stdout.write(
-            "Tags processed=%d (created=%d)"
-            % (c["tags"], c["tags_created"])
+        if not self.pool:
+            thumbnails.set_rendered_images(self.rendered)
+        pending = deque()
+        try:
+            while True:
+                rows = list(islice(reader, chunk_size))
+                if rows:
+                    pending.append((rows, self.submit_images(rows)))
+                if not pending:
+                    return self.counter
+                if len(pending) > self.PREFETCH or not rows:
+                    self.write_chunk(*pending.popleft())
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+            else:
+                thumbnails.set_rendered_images(())
+
+    def submit_images(self, rows):
+        """A future per row, each file of the chunk submitted once."""
+        futures = {}
+        for row in rows:
+            filename = row["image_filename"]
+            if filename not in futures:
+                futures[filename] = self.submit(
+                    thumbnails.ingest,
+                    os.path.join(self.image_basedir, filename),
+                    filename,
+                )
+        return [futures[row["image_filename"]] for row in rows]
+
+    def submit(self, fn, *args):
+        if self.pool:
+            return self.pool.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def write_chunk(self, rows, images):
+        with transaction.atomic():
+            products = self.import_chunk(rows, images)
+        pagecache.purge_products(
+            *catalog.listed_in(
+                models.Product.objects.filter(
+                    pk__in=[product.pk for product in products]
+                )
+            )
         )
-        self.stdout.write(
-            "Images processed=%d" % c["images"]
+
+    def import_chunk(self, rows, images):
+        c = self.counter
+        created = []
+        new_tags = []
+        row_products = []
+        for row in rows:
+            key = (row["name"], Decimal(row["price"]))
+            product = self.products.get(key)
+            if product is None:
+                product = models.Product(name=key[0], price=key[1])
+                self.products[key] = product
+                created.append(product)
+                c["products_created"] += 1
+            product.description = row["description"]
+            product.slug = slugify(row["name"])
+            row_products.append(product)
+            c["products"] += 1
+            for import_tag in row["tags"].split("|"):
+                if import_tag not in self.tags:
+                    slug = slugify(import_tag)
+                    tag = self.tag_slugs.get(slug)
+                    if tag is None:
+                        tag = models.ProductTag(name=import_tag, slug=slug)
+                        self.tag_slugs[slug] = tag
+                        new_tags.append(tag)
+                        c["tags_created"] += 1
+                    self.tags[import_tag] = tag
+                c["tags"] += 1
+
+        products = list({id(p): p for p in row_products}.values())
+        existing = [product for product in products if product.pk]
+        now = timezone.now()
+        for product in existing:
+            product.date_updated = now
+        models.Product.objects.bulk_create(created)
+        models.Product.objects.bulk_update(
+            existing, ["description", "slug", "date_updated"]
+        )
+        models.ProductTag.objects.bulk_create(new_tags)
+
+        through = models.Product.tags.through
+        through.objects.bulk_create(
+            [
+                through(product_id=product.pk, producttag_id=tag.pk)
+                for product, tag in {
+                    (product, self.tags[import_tag])
+                    for row, product in zip(rows, row_products)
+                    for import_tag in row["tags"].split("|")
+                }
+            ],
+            ignore_conflicts=True,
+        )
+
+        new_images = []
+        renditions = []
+        jobs = []
+        for product, future in zip(row_products, images):
+            name, thumbnail, made, error = future.result()
+            c["images"] += 1
+            if (product.pk, name) in self.images:
+                continue
+            self.images.add((product.pk, name))
+            if thumbnail is None and not error and name in self.rendered:
+                # Skipped by the workers as rendered before the import
+                thumbnail, made = self.rendered[name]
+            image = models.ProductImage(
+                product=product, image=name, thumbnail=thumbnail
+            )
+            new_images.append(image)
+            renditions.append((image, made))
+            if thumbnail is None:
+                # Failures are retried by process_thumbnails
+                jobs.append(models.ThumbnailJob(image=image))
+        models.ProductImage.objects.bulk_create(new_images)
+        models.ProductImageRendition.objects.bulk_create(
+            models.ProductImageRendition(
+                image=image, width=width, format=format, file=file
+            )
+            for image, made in renditions
+            for width, format, file in made
+        )
+        models.ThumbnailJob.objects.bulk_create(jobs)
+
+        models.Product.objects.update_search_vector(
+            [product.pk for product in products]
         )
+        return products
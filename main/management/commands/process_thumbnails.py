@@ -0,0 +1,42 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from main.thumbnails import process_jobs, worker_pool
+
+
+class Command(BaseCommand):
+    help = 'Generate the thumbnails queued by product image saves'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Processes resizing images; 1 resizes in this process",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=20,
+            help="Jobs claimed per transaction",
+        )
+        parser.add_argument(
+            "--poll", type=float, default=2,
+            help="Seconds to wait when the queue is empty",
+        )
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Exit when the queue is empty",
+        )
+
+    def handle(self, *args, **options):
+        pool = worker_pool(options["workers"])
+        processed = 0
+        try:
+            while True:
+                claimed = process_jobs(options["batch_size"], pool)
+                processed += claimed
+                if not claimed:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll"])
+        finally:
+            if pool:
+                pool.shutdown()
+        self.stdout.write("Processed thumbnails=%d" % processed)
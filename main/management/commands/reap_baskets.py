@@ -0,0 +1,111 @@
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Delete abandoned baskets and expired sessions in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--open-days", type=int, default=30,
+            help="Age in days after which open baskets are deleted",
+        )
+        parser.add_argument(
+            "--submitted-days", type=int, default=7,
+            help="Age in days after which submitted baskets are deleted",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Rows deleted per statement",
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0.5,
+            help="Seconds to sleep between batches",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report what would be deleted",
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        self.batch_size = options["batch_size"]
+        self.sleep = options["sleep"]
+        self.dry_run = options["dry_run"]
+        targets = [
+            (
+                "open baskets",
+                models.Basket.objects.filter(
+                    status=models.Basket.OPEN,
+                    date_updated__lt=now - timedelta(
+                        days=options["open_days"]
+                    ),
+                ).order_by("date_updated"),
+            ),
+            (
+                "submitted baskets",
+                models.Basket.objects.filter(
+                    status=models.Basket.SUBMITTED,
+                    date_updated__lt=now - timedelta(
+                        days=options["submitted_days"]
+                    ),
+                ).order_by("date_updated"),
+            ),
+        ]
+        if settings.SESSION_ENGINE == "django.contrib.sessions.backends.db":
+            targets.append(
+                (
+                    "expired sessions",
+                    Session.objects.filter(
+                        expire_date__lt=now
+                    ).order_by("expire_date"),
+                )
+            )
+        for name, queryset in targets:
+            if self.dry_run:
+                self.stdout.write(
+                    "Would delete %s=%d" % (name, queryset.count())
+                )
+            else:
+                deleted = self.delete_in_batches(queryset)
+                self.stdout.write("Deleted %s=%d" % (name, deleted))
+
+    def pick_batch(self, queryset):
+        return list(queryset.values_list("pk", flat=True)[:self.batch_size])
+
+    def delete_in_batches(self, queryset):
+        # Each batch is picked through the (status, date_updated) or
+        # expire_date index and deleted by primary key, so no
+        # statement holds locks on more than batch_size rows.
+        deleted = 0
+        while True:
+            picked = self.pick_batch(queryset)
+            if not picked:
+                return deleted
+            # Rows changed since they were picked, like a basket with
+            # a new item, no longer match the queryset and are kept.
+            batch = queryset.filter(pk__in=picked)
+            with transaction.atomic():
+                if queryset.model is models.Basket:
+                    # Locked so that they stay abandoned until deleted
+                    pks = list(
+                        batch.select_for_update().values_list(
+                            "pk", flat=True
+                        )
+                    )
+                    models.BasketLine.objects.filter(
+                        basket_id__in=pks
+                    ).delete()
+                    batch = models.Basket.objects.filter(pk__in=pks)
+                deleted += batch.delete()[1].get(
+                    queryset.model._meta.label, 0
+                )
+            if len(picked) < self.batch_size:
+                return deleted
+            time.sleep(self.sleep)
@@ -0,0 +1,50 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Min
+from main import models
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the "customers also bought" tables from all orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--chunk-size", type=int, default=5000,
+            help="Orders counted per statement",
+        )
+        parser.add_argument(
+            "--sleep", type=float, default=0,
+            help="Seconds to sleep between chunks",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        # Orders created from here on are counted by create_order, so
+        # the rebuild stops at the last order that exists now.
+        with transaction.atomic():
+            models.CoPurchase.objects.all().delete()
+            bounds = models.Order.objects.aggregate(
+                first=Min("id"), last=Max("id")
+            )
+        if bounds["first"] is not None:
+            for first_id in range(
+                bounds["first"], bounds["last"] + 1, chunk_size
+            ):
+                last_id = min(first_id + chunk_size - 1, bounds["last"])
+                with transaction.atomic():
+                    pairs = models.CoPurchase.objects.add_orders(
+                        first_id, last_id
+                    )
+                self.stdout.write(
+                    "Counted orders %d-%d pairs=%d"
+                    % (first_id, last_id, pairs)
+                )
+                if options["sleep"]:
+                    time.sleep(options["sleep"])
+        with transaction.atomic():
+            models.Recommendation.objects.refresh()
+        self.stdout.write(
+            "Rebuilt recommendations=%d"
+            % models.Recommendation.objects.count()
+        )
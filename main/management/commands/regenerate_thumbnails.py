@@ -0,0 +1,77 @@
+import os
+import time
+from django.core.management.base import BaseCommand
+from main import models
+from main.thumbnails import regenerate, worker_pool
+
+
+class Command(BaseCommand):
+    help = 'Remake the thumbnails and renditions of all product images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count(),
+            help="Processes resizing images; 1 resizes in this process",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Images written per transaction",
+        )
+        parser.add_argument(
+            "--start-after", type=int, default=0,
+            help="Skip images up to this id, to resume an earlier run",
+        )
+        parser.add_argument(
+            "--max-rate", type=float, default=0,
+            help="Images per second not to exceed; 0 for no limit",
+        )
+
+    def handle(self, *args, **options):
+        pool = worker_pool(options["workers"])
+        images = (
+            models.ProductImage.objects.filter(
+                id__gt=options["start_after"]
+            )
+            .only("id", "product_id", "image", "thumbnail")
+            .order_by("id")
+        )
+        started = time.monotonic()
+        processed = failed = 0
+        batch = []
+        try:
+            # A server-side cursor, so the catalog is never all in memory
+            for image in images.iterator(chunk_size=options["batch_size"]):
+                batch.append(image)
+                if len(batch) == options["batch_size"]:
+                    failed += self.regenerate(batch, pool)
+                    processed += len(batch)
+                    batch = []
+                    self.throttle(processed, started, options["max_rate"])
+            if batch:
+                failed += self.regenerate(batch, pool)
+                processed += len(batch)
+        finally:
+            if pool:
+                pool.shutdown()
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            "Regenerated thumbnails=%d failed=%d in %.1fs (%.1f images/s)"
+            % (
+                processed - failed,
+                failed,
+                elapsed,
+                processed / elapsed if elapsed else 0,
+            )
+        )
+
+    def regenerate(self, batch, pool):
+        failed = regenerate(batch, pool)
+        # Printed once the batch is committed, for --start-after
+        self.stdout.write("Done up to id=%d" % batch[-1].id)
+        return failed
+
+    def throttle(self, processed, started, max_rate):
+        if max_rate:
+            ahead = processed / max_rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
@@ -1,16 +1,117 @@
+import logging
+import time
+from django.utils.functional import SimpleLazyObject, empty
 from . import models
+from .baskets import SessionBasket
+
+logger = logging.getLogger(__name__)
+
+# Seconds the basket id and count kept in the session are shown
+# without reading the basket, so that changes made outside the
+# session, like a deleted product, show within that time.
+BASKET_SUMMARY_TIMEOUT = 60
+
+
+def get_basket(request):
+    basket_id = request.session.get("basket_id")
+    if basket_id is None:
+        if SessionBasket.SESSION_KEY in request.session:
+            return SessionBasket(request.session)
+        return None
+    # Read from the database, so that views change the basket as it
+    # is. The row is read at most once per request, and pages that
+    # only show the basket use request.basket_summary instead.
+    try:
+        return models.Basket.objects.get(id=basket_id)
+    except models.Basket.DoesNotExist:
+        logger.info(
+            "Dropping stale basket id %d from session", basket_id
+        )
+        del request.session["basket_id"]
+        return None
+
+
+def loaded_basket(request):
+    """
+    The basket of the request if it was read or replaced by now, or
+    empty if it has not been looked up.
+    """
+    basket = request.basket
+    if isinstance(basket, SimpleLazyObject):
+        return basket._wrapped
+    return basket
+
+
+class BasketSummary:
+    """
+    The id and item count of the basket, which the page header and the
+    page validators show. They are kept in the session, which is loaded
+    anyway, so pages that only show them need no query. A basket the
+    request has read or changed is used as it is.
+    """
+
+    SESSION_KEY = "basket_summary"
+
+    def __init__(self, request):
+        self.request = request
+
+    def get(self):
+        session = self.request.session
+        basket = loaded_basket(self.request)
+        if basket is empty and "basket_id" in session:
+            summary = session.get(self.SESSION_KEY)
+            if (
+                summary
+                and summary[0] == session["basket_id"]
+                and time.time() - summary[2] < BASKET_SUMMARY_TIMEOUT
+            ):
+                return summary[0], summary[1]
+        basket = self.request.basket
+        if not basket:
+            return None
+        return basket.id, basket.count()
+
+    def __bool__(self):
+        return self.get() is not None
+
+    @property
+    def id(self):
+        summary = self.get()
+        return summary[0] if summary else None
+
+    def count(self):
+        summary = self.get()
+        return summary[1] if summary else 0
+
+    def save(self):
+        """Keep what the request left of its database basket."""
+        session = self.request.session
+        basket = loaded_basket(self.request)
+        if basket is empty:
+            return
+        if basket and basket.id and session.get("basket_id") == basket.id:
+            summary = session.get(self.SESSION_KEY)
+            if (
+                not summary
+                or summary[:2] != [basket.id, basket.count()]
+                or time.time() - summary[2] >= BASKET_SUMMARY_TIMEOUT
+            ):
+                session[self.SESSION_KEY] = [
+                    basket.id, basket.count(), time.time()
+                ]
+        elif self.SESSION_KEY in session:
+            del session[self.SESSION_KEY]
 
 
 def basket_middleware(get_response):
     def middleware(request):
-        if 'basket_id' in request.session:
-            basket_id = request.session['basket_id']
-            basket = models.Basket.objects.get(id=basket_id)
-            request.basket = basket
-        else:
-            request.basket = None
+        # The basket is only looked up when a view or template
+        # actually accesses it
+        request.basket = SimpleLazyObject(lambda: get_basket(request))
+        request.basket_summary = BasketSummary(request)
 
         response = get_response(request)
+        request.basket_summary.save()
         return response
 
     return middleware
@@ -0,0 +1,58 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:17
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+COUNTER_FIELDS = {
+    10: "new_lines",
+    20: "processing_lines",
+    30: "sent_lines",
+    40: "cancelled_lines",
+}
+
+
+def populate_line_counters(apps, schema_editor):
+    Order = apps.get_model("main", "Order")
+    annotations = {
+        "c_%s" % field: Count("lines", filter=Q(lines__status=status))
+        for status, field in COUNTER_FIELDS.items()
+    }
+    orders = Order.objects.annotate(**annotations)
+    for order in orders.iterator():
+        Order.objects.filter(pk=order.pk).update(**{
+            field: getattr(order, "c_%s" % field)
+            for field in COUNTER_FIELDS.values()
+        })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_auto_20190814_0450'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='cancelled_lines',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='new_lines',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='processing_lines',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='sent_lines',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            populate_line_counters, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:20
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def populate_item_count(apps, schema_editor):
+    Basket = apps.get_model("main", "Basket")
+    BasketLine = apps.get_model("main", "BasketLine")
+    total = (
+        BasketLine.objects.filter(basket=OuterRef("pk"))
+        .order_by()
+        .values("basket")
+        .annotate(total=Sum("quantity"))
+        .values("total")
+    )
+    Basket.objects.update(item_count=Coalesce(Subquery(total), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_order_line_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basket',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(
+            populate_item_count, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:21
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def fold_duplicate_lines(apps, schema_editor):
+    BasketLine = apps.get_model("main", "BasketLine")
+    duplicates = (
+        BasketLine.objects.values("basket", "product")
+        .annotate(c=Count("id"), first=Min("id"), total=Sum("quantity"))
+        .filter(c__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        lines = BasketLine.objects.filter(
+            basket=duplicate["basket"], product=duplicate["product"]
+        )
+        lines.exclude(id=duplicate["first"]).delete()
+        lines.update(quantity=duplicate["total"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_basket_item_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            fold_duplicate_lines, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='basketline',
+            constraint=models.UniqueConstraint(fields=('basket', 'product'), name='unique_basket_product'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_basketline_unique_product'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basket',
+            name='date_updated',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='basket',
+            index=models.Index(fields=['status', 'date_updated'], name='basket_status_updated_idx'),
+        ),
+    ]
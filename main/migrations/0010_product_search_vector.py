@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:26
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+POPULATE_SEARCH_VECTOR = """
+UPDATE main_product p SET search_vector =
+    setweight(to_tsvector('english', coalesce(p.name, '')), 'A')
+    || setweight(to_tsvector('english', coalesce((
+        SELECT string_agg(t.name, ' ')
+        FROM main_producttag t
+        JOIN main_product_tags pt ON pt.producttag_id = t.id
+        WHERE pt.product_id = p.id
+    ), '')), 'B')
+    || setweight(to_tsvector('english', coalesce(p.description, '')), 'C')
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_basket_date_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='product_search_idx'),
+        ),
+        migrations.RunSQL(POPULATE_SEARCH_VECTOR, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:27
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils.text import slugify
+
+
+def deduplicate_tag_slugs(apps, schema_editor):
+    ProductTag = apps.get_model("main", "ProductTag")
+    duplicates = (
+        ProductTag.objects.values("slug")
+        .annotate(c=Count("id"))
+        .filter(c__gt=1)
+        .order_by()
+    )
+    for duplicate in duplicates:
+        tags = ProductTag.objects.filter(
+            slug=duplicate["slug"]
+        ).order_by("id")
+        for tag in tags[1:]:
+            base = duplicate["slug"] or slugify(tag.name) or "tag"
+            tag.slug = "%s-%d" % (base[:36], tag.id)
+            tag.save(update_fields=["slug"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_product_search_vector'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            deduplicate_tag_slugs, migrations.RunPython.noop
+        ),
+        migrations.AlterField(
+            model_name='producttag',
+            name='slug',
+            field=models.SlugField(max_length=48, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'date_added', 'id'], name='order_status_added_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderline',
+            index=models.Index(fields=['order', 'status'], name='orderline_order_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(condition=models.Q(active=True), fields=['name', 'id'], name='product_active_name_idx'),
+        ),
+    ]
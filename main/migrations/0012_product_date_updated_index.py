@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['date_updated'], name='product_date_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:38
+
+from django.db import migrations, models
+from django.db.models import Q
+import django.db.models.deletion
+
+
+def enqueue_missing_thumbnails(apps, schema_editor):
+    ProductImage = apps.get_model("main", "ProductImage")
+    ThumbnailJob = apps.get_model("main", "ThumbnailJob")
+    ThumbnailJob.objects.bulk_create(
+        ThumbnailJob(image_id=image_id)
+        for image_id in ProductImage.objects.filter(
+            Q(thumbnail="") | Q(thumbnail__isnull=True)
+        ).values_list("id", flat=True)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_recommendations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnail_job', to='main.ProductImage')),
+            ],
+        ),
+        migrations.RunPython(
+            enqueue_missing_thumbnails, migrations.RunPython.noop
+        ),
+    ]
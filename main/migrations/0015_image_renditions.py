@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def enqueue_images(apps, schema_editor):
+    # The thumbnail workers make the renditions of existing images
+    ProductImage = apps.get_model("main", "ProductImage")
+    ThumbnailJob = apps.get_model("main", "ThumbnailJob")
+    ThumbnailJob.objects.bulk_create(
+        ThumbnailJob(image_id=image_id)
+        for image_id in ProductImage.objects.filter(
+            thumbnail_job__isnull=True
+        ).values_list("id", flat=True)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0014_thumbnail_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductImageRendition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('width', models.PositiveSmallIntegerField()),
+                ('format', models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')], max_length=4)),
+                ('file', models.ImageField(upload_to='product-renditions')),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='renditions', to='main.ProductImage')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productimagerendition',
+            constraint=models.UniqueConstraint(fields=('image', 'width', 'format'), name='unique_rendition'),
+        ),
+        migrations.RunPython(enqueue_images, migrations.RunPython.noop),
+    ]
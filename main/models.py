@@ -1,10 +1,33 @@
-from django.db import models
+from collections import Counter, defaultdict
+from functools import partial
+from django.db import connections, models, transaction
+from django.db.models import (
+    F, OuterRef, Q, Subquery, Sum, Value
+)
+from django.db.models.functions import Coalesce, Concat
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVectorField,
+)
+from django.utils import timezone
+from django.utils.text import slugify
+from django.utils.functional import cached_property
 from django.contrib.auth.models import (
     AbstractUser,
     BaseUserManager,
 )
 from django.core.validators import MinValueValidator
 import logging
+from . import pagecache
+from .storage import media_storage
+from .search import (
+    SEARCH_CONFIG,
+    SearchHeadline,
+    product_search_vector,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -14,10 +37,57 @@ class ActiveManager(models.Manager):
         return self.filter(active=True)
 
 
+class ProductManager(ActiveManager):
+    def update_search_vector(self, products):
+        """
+        Recompute the search vector of products in one UPDATE. Their
+        tag names show on the product page too, so date_updated moves.
+        """
+        tag_names = (
+            ProductTag.objects.filter(product=OuterRef("pk"))
+            .order_by()
+            .values("product")
+            .annotate(names=StringAgg("name", " "))
+            .values("names")
+        )
+        return self.filter(pk__in=products).update(
+            search_vector=product_search_vector(Subquery(tag_names)),
+            date_updated=timezone.now(),
+        )
+
+    def search(self, text):
+        """Active products matching text, best matches first."""
+        query = SearchQuery(text, config=SEARCH_CONFIG)
+        return (
+            self.active()
+            .filter(search_vector=query)
+            .annotate(
+                rank=SearchRank(F("search_vector"), query),
+                headline=SearchHeadline(
+                    Concat("name", Value(". "), "description"), query
+                ),
+            )
+            .order_by("-rank", "name", "id")
+        )
+
+
 class ProductTagManager(models.Manager):
     def get_by_natural_key(self, slug):
         return self.get(slug=slug)
 
+    def get_or_create_for_name(self, name):
+        """
+        The tag called name or else the one with its slug, created if
+        there is neither. Slugs are unique, so names that slugify the
+        same share a tag. Returns (tag, created).
+        """
+        tag = self.filter(name=name).order_by("id").first()
+        if tag is not None:
+            return tag, False
+        return self.get_or_create(
+            slug=slugify(name), defaults={"name": name}
+        )
+
 
 class UserManager(BaseUserManager):
     use_in_migrations = True
@@ -63,12 +133,18 @@ class User(AbstractUser):
 
     objects = UserManager()
 
+    # Loaded once per instance, which for request.user means once per
+    # request. Cleared by the m2m_changed receiver on User.groups.
+    @cached_property
+    def group_names(self):
+        return set(self.groups.values_list("name", flat=True))
+
     @property
     def is_employee(self):
         return self.is_active and (
             self.is_superuser
             or self.is_staff
-            and self.groups.filter(name="Employees").exists()
+            and "Employees" in self.group_names
         )
 
     @property
@@ -76,13 +152,13 @@ class User(AbstractUser):
         return self.is_active and (
             self.is_superuser
             or self.is_staff
-            and self.groups.filter(name="Dispatchers").exists()
+            and "Dispatchers" in self.group_names
         )
 
 
 class ProductTag(models.Model):
     name = models.CharField(max_length=32)
-    slug = models.SlugField(max_length=48)
+    slug = models.SlugField(max_length=48, unique=True)
     description = models.TextField(blank=True)
     active = models.BooleanField(default=True)
     objects = ProductTagManager()
@@ -96,7 +172,7 @@ class ProductTag(models.Model):
 
 class Product(models.Model):
     tags = models.ManyToManyField(ProductTag, blank=True)
-    objects = ActiveManager()
+    objects = ProductManager()
     name = models.CharField(max_length=32)
     description = models.TextField(blank=True)
     price = models.DecimalField(max_digits=6, decimal_places=2)
@@ -104,6 +180,23 @@ class Product(models.Model):
     active = models.BooleanField(default=True)
     in_stock = models.BooleanField(default=True)
     date_updated = models.DateTimeField(auto_now=True)
+    # Weighted name, tag names and description; maintained by signals
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=["search_vector"], name="product_search_idx"),
+            # Catalog listings: active products by (name, id)
+            models.Index(
+                fields=["name", "id"],
+                name="product_active_name_idx",
+                condition=Q(active=True),
+            ),
+            # Last-Modified of the catalog
+            models.Index(
+                fields=["date_updated"], name="product_date_updated_idx"
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -113,8 +206,60 @@ class ProductImage(models.Model):
     product = models.ForeignKey(
         Product, on_delete=models.CASCADE
     )
-    image = models.ImageField(upload_to="product-images")
-    thumbnail = models.ImageField(upload_to="product-thumbnails", null=True)
+    image = models.ImageField(
+        upload_to="product-images", storage=media_storage
+    )
+    thumbnail = models.ImageField(
+        upload_to="product-thumbnails", storage=media_storage, null=True
+    )
+
+
+class ProductImageRendition(models.Model):
+    """A resized copy of a product image, for srcset attributes."""
+
+    WEBP = "webp"
+    JPEG = "jpeg"
+    FORMATS = ((WEBP, "WebP"), (JPEG, "JPEG"))
+    WIDTHS = (150, 300, 600, 1200)
+
+    image = models.ForeignKey(
+        ProductImage, on_delete=models.CASCADE, related_name="renditions"
+    )
+    width = models.PositiveSmallIntegerField()
+    format = models.CharField(max_length=4, choices=FORMATS)
+    file = models.ImageField(
+        upload_to="product-renditions", storage=media_storage
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["image", "width", "format"],
+                name="unique_rendition",
+            ),
+        ]
+
+
+class ThumbnailJobManager(models.Manager):
+    def enqueue(self, image):
+        self.update_or_create(image=image, defaults={"attempts": 0})
+
+
+class ThumbnailJob(models.Model):
+    """
+    A product image waiting for its thumbnail. The table is the queue
+    of the process_thumbnails workers, so jobs survive restarts.
+    """
+
+    MAX_ATTEMPTS = 3
+
+    image = models.OneToOneField(
+        ProductImage, on_delete=models.CASCADE, related_name="thumbnail_job"
+    )
+    date_added = models.DateTimeField(auto_now_add=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    objects = ThumbnailJobManager()
 
 
 class Address(models.Model):
@@ -150,6 +295,22 @@ class Address(models.Model):
         )
 
 
+class BasketQuerySet(models.QuerySet):
+    def refresh_item_counts(self):
+        """Recompute item_count from the lines in a single UPDATE."""
+        total = (
+            BasketLine.objects.filter(basket=OuterRef("pk"))
+            .order_by()
+            .values("basket")
+            .annotate(total=Sum("quantity"))
+            .values("total")
+        )
+        return self.update(
+            item_count=Coalesce(Subquery(total), 0),
+            date_updated=timezone.now(),
+        )
+
+
 class Basket(models.Model):
     OPEN = 10
     SUBMITTED = 20
@@ -159,12 +320,61 @@ class Basket(models.Model):
         User, on_delete=models.CASCADE, blank=True, null=True
     )
     status = models.IntegerField(choices=STATUSES, default=OPEN)
+    # Total quantity over all lines, denormalized so that the basket
+    # badge rendered on every page does not need to load the lines.
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = BasketQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "date_updated"],
+                name="basket_status_updated_idx",
+            ),
+        ]
 
     def is_empty(self):
-        return self.basketline_set.all().count() == 0
+        return self.item_count == 0
 
     def count(self):
-        return sum(i.quantity for i in self.basketline_set.all())
+        return self.item_count
+
+    def add_product(self, product, quantity=1):
+        return BasketLine.objects.add_product(self, product, quantity)
+
+    def merge(self, other):
+        """
+        Move the lines of other into this basket, summing quantities of
+        products present in both, and delete other.
+        """
+        other_lines = BasketLine.objects.filter(basket=other)
+        with transaction.atomic():
+            self.basketline_set.filter(
+                product__in=other_lines.values("product")
+            ).update(
+                quantity=F("quantity") + Subquery(
+                    other_lines.filter(
+                        product=OuterRef("product")
+                    ).values("quantity")
+                )
+            )
+            other_lines.filter(
+                product__in=self.basketline_set.values("product")
+            ).delete()
+            other_lines.update(basket=self)
+            Basket.objects.filter(pk=self.pk).update(
+                item_count=F("item_count") + other.item_count,
+                date_updated=timezone.now(),
+            )
+            other.delete()
+        self.item_count += other.item_count
+
+    def refresh_item_count(self):
+        """Recompute item_count from the lines in a single UPDATE."""
+        Basket.objects.filter(pk=self.pk).refresh_item_counts()
+        self.refresh_from_db(fields=["item_count"])
 
     def create_order(self, billing_address, shipping_address):
         if not self.user:
@@ -193,29 +403,92 @@ class Basket(models.Model):
             "shipping_city": shipping_address.city,
             "shipping_country": shipping_address.country,
         }
-        order = Order.objects.create(**order_data)
-        c = 0
-        for line in self.basketline_set.all():
-            for item in range(line.quantity):
-                order_line_data = {
-                    "order": order,
-                    "product": line.product
-                }
-                order_line = OrderLine.objects.create(
-                    **order_line_data
+        with transaction.atomic():
+            lines = list(self.basketline_set.select_related("product"))
+            order_data["new_lines"] = sum(line.quantity for line in lines)
+            order = Order.objects.create(**order_data)
+            order_lines = [
+                OrderLine(order=order, product=line.product)
+                for line in lines
+                for item in range(line.quantity)
+            ]
+            OrderLine.objects.bulk_create(order_lines)
+            # Off the checkout transaction: a failure there must not
+            # lose the order, nor concurrent checkouts wait on it.
+            transaction.on_commit(
+                partial(
+                    Recommendation.objects.add_order,
+                    {line.product_id for line in lines},
                 )
-                c += 1
-        logger.info(
-            "Created order with id=%d and lines_count=%d",
-            order.id,
-            c,
-        )
-        self.status = Basket.SUBMITTED
-        self.save()
+            )
+            logger.info(
+                "Created order with id=%d and lines_count=%d",
+                order.id,
+                len(order_lines),
+            )
+            self.status = Basket.SUBMITTED
+            self.save()
         return order
 
 
 
+class BasketLineManager(models.Manager):
+    def add_products(self, basket, quantities):
+        """
+        Add quantities, a mapping of product ids to quantities, to
+        basket in a single statement.
+
+        Lines are upserted and the basket item count incremented by
+        the database, so concurrent adds never lose an increment.
+        basket.item_count is updated in place and the touched lines
+        are returned.
+        """
+        sql = """
+            WITH line AS (
+                INSERT INTO {line_table} (basket_id, product_id, quantity)
+                VALUES {values}
+                ON CONFLICT (basket_id, product_id) DO UPDATE
+                SET quantity = {line_table}.quantity + EXCLUDED.quantity
+                RETURNING id, product_id, quantity
+            ), basket AS (
+                UPDATE {basket_table}
+                SET item_count = item_count + %s, date_updated = %s
+                WHERE id = %s
+                RETURNING item_count
+            )
+            SELECT line.id, line.product_id, line.quantity, basket.item_count
+            FROM line, basket
+        """.format(
+            line_table=self.model._meta.db_table,
+            basket_table=Basket._meta.db_table,
+            values=", ".join(["(%s, %s, %s)"] * len(quantities)),
+        )
+        params = []
+        for product_id, quantity in quantities.items():
+            params += [basket.id, product_id, quantity]
+        params += [sum(quantities.values()), timezone.now(), basket.id]
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        lines = []
+        for line_id, product_id, quantity, item_count in rows:
+            basket.item_count = item_count
+            lines.append(
+                self.model(
+                    id=line_id,
+                    basket=basket,
+                    product_id=product_id,
+                    quantity=quantity,
+                )
+            )
+        return lines
+
+    def add_product(self, basket, product, quantity=1):
+        [line] = self.add_products(basket, {product.id: quantity})
+        line.product = product
+        return line
+
+
 class BasketLine(models.Model):
     basket = models.ForeignKey(Basket, on_delete=models.CASCADE)
     product = models.ForeignKey(
@@ -225,6 +498,16 @@ class BasketLine(models.Model):
         default=1, validators=[MinValueValidator(1)]
     )
 
+    objects = BasketLineManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["basket", "product"],
+                name="unique_basket_product",
+            ),
+        ]
+
 
 class Order(models.Model):
     NEW = 10
@@ -256,6 +539,101 @@ class Order(models.Model):
     date_updated = models.DateTimeField(auto_now=True)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    # Per-status line counters, kept up to date by the OrderLine
+    # signals so that the order status can be rolled up without
+    # scanning the lines table.
+    new_lines = models.PositiveIntegerField(default=0, editable=False)
+    processing_lines = models.PositiveIntegerField(
+        default=0, editable=False
+    )
+    sent_lines = models.PositiveIntegerField(default=0, editable=False)
+    cancelled_lines = models.PositiveIntegerField(
+        default=0, editable=False
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "date_added", "id"],
+                name="order_status_added_idx",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        # The OrderLine signals change the counters, and the status
+        # they roll up to, with relative updates. Writing back what
+        # this instance loaded would undo those made since, so saves
+        # leave the counters out and the status too unless it was
+        # changed here.
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            skipped = set(OrderLine.COUNTER_FIELDS.values())
+            if self.status == self._loaded_status:
+                skipped.add("status")
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in skipped
+            ]
+        super().save(*args, **kwargs)
+        self._loaded_status = self.status
+
+
+class OrderLineQuerySet(models.QuerySet):
+    def set_status(self, status):
+        """
+        Move every line in the queryset to status with a single UPDATE
+        and roll the change up into the counters of each affected order.
+        Returns the number of matched lines.
+        """
+        with transaction.atomic():
+            lines = list(
+                self.order_by()
+                .select_for_update(of=("self",))
+                .values_list("id", "order_id", "status")
+            )
+            invalid = [
+                pk
+                for pk, order_id, current in lines
+                if current != status
+                and status not in self.model.TRANSITIONS[current]
+            ]
+            if invalid:
+                raise ValueError(
+                    "Invalid status transition for lines %s"
+                    % ", ".join(str(pk) for pk in invalid)
+                )
+            deltas = defaultdict(Counter)
+            changed = []
+            for pk, order_id, current in lines:
+                if current != status:
+                    changed.append(pk)
+                    deltas[order_id][current] -= 1
+                    deltas[order_id][status] += 1
+            self.model.objects.filter(id__in=changed).update(status=status)
+
+            for order_id, delta in deltas.items():
+                counters = {}
+                for line_status, n in delta.items():
+                    field = self.model.COUNTER_FIELDS[line_status]
+                    counters[field] = F(field) + n
+                Order.objects.filter(pk=order_id).update(
+                    date_updated=timezone.now(), **counters
+                )
+            marked = 0
+            if status >= self.model.SENT:
+                marked = Order.objects.filter(
+                    pk__in=deltas, new_lines=0, processing_lines=0
+                ).exclude(status=Order.DONE).update(
+                    status=Order.DONE, date_updated=timezone.now()
+                )
+        logger.info(
+            "Moved %d lines to status %d, marked %d orders as done",
+            len(changed),
+            status,
+            marked,
+        )
+        return len(lines)
+
 
 class OrderLine(models.Model):
     NEW = 10
@@ -268,6 +646,18 @@ class OrderLine(models.Model):
         (SENT, "Sent"),
         (CANCELLED, "Cancelled"),
     )
+    COUNTER_FIELDS = {
+        NEW: "new_lines",
+        PROCESSING: "processing_lines",
+        SENT: "sent_lines",
+        CANCELLED: "cancelled_lines",
+    }
+    TRANSITIONS = {
+        NEW: (PROCESSING, SENT, CANCELLED),
+        PROCESSING: (SENT, CANCELLED),
+        SENT: (),
+        CANCELLED: (),
+    }
 
     order = models.ForeignKey(
         Order, on_delete=models.CASCADE, related_name="lines"
@@ -276,3 +666,193 @@ class OrderLine(models.Model):
         Product, on_delete=models.PROTECT
     )
     status = models.IntegerField(choices=STATUSES, default=NEW)
+
+    objects = OrderLineQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        # The status signals lock the row before it is written and roll
+        # the change up into the order counters after: all of it or
+        # none must happen, or the counters drift from the lines.
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["order", "status"],
+                name="orderline_order_status_idx",
+            ),
+        ]
+
+
+class CoPurchaseManager(models.Manager):
+    def record(self, product_ids):
+        """
+        Count one more order for every pair of distinct products in
+        product_ids, in both directions, with a single upsert.
+        """
+        product_ids = sorted(set(product_ids))
+        if len(product_ids) < 2:
+            return
+        sql = """
+            INSERT INTO {table} (product_id, other_id, count)
+            SELECT a, b, 1
+            FROM unnest(%s) AS a, unnest(%s) AS b
+            WHERE a <> b
+            -- Rows are locked in the same order by every checkout
+            ORDER BY a, b
+            ON CONFLICT (product_id, other_id) DO UPDATE
+            SET count = {table}.count + EXCLUDED.count
+        """.format(table=self.model._meta.db_table)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, [product_ids, product_ids])
+
+    def add_orders(self, first_id, last_id):
+        """
+        Count the product pairs of the orders with ids in
+        [first_id, last_id] in one aggregate over their lines.
+        """
+        sql = """
+            INSERT INTO {table} (product_id, other_id, count)
+            SELECT a.product_id, b.product_id, COUNT(DISTINCT a.order_id)
+            FROM {line_table} a
+            JOIN {line_table} b
+                ON b.order_id = a.order_id AND b.product_id <> a.product_id
+            WHERE a.order_id BETWEEN %s AND %s
+            GROUP BY a.product_id, b.product_id
+            ON CONFLICT (product_id, other_id) DO UPDATE
+            SET count = {table}.count + EXCLUDED.count
+        """.format(
+            table=self.model._meta.db_table,
+            line_table=OrderLine._meta.db_table,
+        )
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(sql, [first_id, last_id])
+            return cursor.rowcount
+
+
+class CoPurchase(models.Model):
+    """How many orders had both product and other. Kept symmetric."""
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="+"
+    )
+    other = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="+"
+    )
+    count = models.PositiveIntegerField(default=0)
+
+    objects = CoPurchaseManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["product", "other"], name="unique_copurchase"
+            ),
+        ]
+
+
+class RecommendationManager(models.Manager):
+    # pg_advisory_xact_lock() key taken by refresh(): concurrent
+    # refreshes of a product would each insert its recommendations.
+    REFRESH_LOCK = 0x7265636F
+
+    def add_order(self, product_ids):
+        """
+        Count an order of product_ids and refresh their
+        recommendations, in a transaction of its own. Failures are
+        logged: the order is already committed.
+        """
+        try:
+            with transaction.atomic():
+                CoPurchase.objects.record(product_ids)
+                self.refresh(product_ids)
+        except Exception:
+            logger.exception(
+                "Cannot update recommendations of products %s",
+                sorted(product_ids),
+            )
+
+    def refresh(self, product_ids=None):
+        """
+        Replace the recommendations of product_ids, or of every
+        product, with their top neighbours by co-purchase count.
+        Products whose recommendations changed are touched, so that
+        their pages are validated and cached afresh.
+        """
+        where = ""
+        params = []
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            if not product_ids:
+                return
+            where = "WHERE product_id = ANY(%s)"
+            params = [product_ids]
+        delete = """
+            DELETE FROM {table} {where}
+            RETURNING product_id, recommended_id, score
+        """
+        insert = """
+            INSERT INTO {table} (product_id, recommended_id, score)
+            SELECT product_id, other_id, count
+            FROM (
+                SELECT product_id, other_id, count, row_number() OVER (
+                    PARTITION BY product_id ORDER BY count DESC, other_id
+                ) AS position
+                FROM {copurchase_table}
+                {where}
+            ) ranked
+            WHERE position <= %s
+            RETURNING product_id, recommended_id, score
+        """
+        names = {
+            "table": self.model._meta.db_table,
+            "copurchase_table": CoPurchase._meta.db_table,
+            "where": where,
+        }
+        with connections[self.db].cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)",
+                           [self.REFRESH_LOCK])
+            cursor.execute(delete.format(**names), params)
+            old = set(cursor.fetchall())
+            cursor.execute(
+                insert.format(**names), params + [self.model.TOP_K]
+            )
+            new = set(cursor.fetchall())
+        changed = {row[0] for row in old ^ new}
+        if changed:
+            Product.objects.filter(pk__in=changed).update(
+                date_updated=timezone.now()
+            )
+            pagecache.purge(*[pagecache.product_tag(pk) for pk in changed])
+
+    def for_product(self, product):
+        return (
+            self.filter(product=product, recommended__active=True)
+            .select_related("recommended")
+            .order_by("-score", "recommended_id")
+        )
+
+
+class Recommendation(models.Model):
+    """The TOP_K products most often bought together with product."""
+
+    TOP_K = 10
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="recommendations"
+    )
+    recommended = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="+"
+    )
+    score = models.PositiveIntegerField()
+
+    objects = RecommendationManager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["product", "-score"],
+                name="recommendation_product_idx",
+            ),
+        ]
@@ -0,0 +1,169 @@
+import hashlib
+from functools import wraps
+from uuid import uuid4
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+
+# Purges are exact for the tags below; the timeout bounds how long a
+# page can show anything else that changed, like the templates.
+PAGE_CACHE_TIMEOUT = 60 * 10
+
+
+def enabled():
+    """
+    Whether pages and catalog lists are cached. They are expired by
+    the process that handles a change, so only with a cache that every
+    process serving the site shares (see SHARED_CACHE).
+    """
+    return settings.SHARED_CACHE
+
+
+def product_tag(product_id):
+    return "product:%d" % product_id
+
+
+def product_slug_tag(slug):
+    return "product-slug:%s" % slug
+
+
+def tag_tag(slug):
+    return "tag:%s" % slug
+
+
+def catalog_tag(tag):
+    return "catalog:%s" % tag
+
+
+def tag_key(tag):
+    return "pagetag:%s" % tag
+
+
+def page_key(request):
+    url = request.build_absolute_uri()
+    return "page:%s" % hashlib.md5(url.encode()).hexdigest()
+
+
+def purge(*tags):
+    """
+    Expire every cached page tagged with any of tags. Each tag has a
+    random version that cached pages record; purging replaces it.
+
+    Within a transaction it is done again on commit, as pages and lists
+    cached meanwhile were read from before the change.
+    """
+    if not tags:
+        return
+
+    def replace_versions():
+        cache.set_many(
+            {tag_key(tag): uuid4().hex for tag in set(tags)}, None
+        )
+
+    replace_versions()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(replace_versions)
+
+
+def purge_products(products, tags=()):
+    """
+    Expire the pages of products and the listings they appear in.
+    tags are the slugs of their product tags.
+    """
+    purge(
+        catalog_tag("all"),
+        *[product_tag(product.pk) for product in products],
+        *[product_slug_tag(product.slug) for product in products],
+        *[catalog_tag(tag) for tag in tags]
+    )
+
+
+def get_versions(tags):
+    keys = [tag_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    missing = {key: uuid4().hex for key in keys if key not in versions}
+    if missing:
+        # add() so that a concurrent purge is not overwritten
+        for key, version in missing.items():
+            if not cache.add(key, version, None):
+                version = cache.get(key)
+            versions[key] = version
+    return versions
+
+
+def is_cacheable(request):
+    # Anonymous pages without a basket or messages look the same for
+    # everyone.
+    return (
+        request.method in ("GET", "HEAD")
+        and not request.user.is_authenticated
+        and not request.basket
+        and not len(get_messages(request))
+    )
+
+
+def cache_anonymous_page(view):
+    """
+    Full-page cache for anonymous requests, keyed by URL. The view
+    tags its response with page_tags (see PageTagsMixin) to be purged
+    with purge().
+    """
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not enabled() or not is_cacheable(request):
+            return view(request, *args, **kwargs)
+
+        key = page_key(request)
+        entry = cache.get(key)
+        if entry is not None:
+            versions, response = entry
+            if cache.get_many(list(versions)) == versions:
+                return get_conditional_response(
+                    request,
+                    etag=response.get("ETag"),
+                    last_modified=parse_http_date_safe(
+                        response.get("Last-Modified", "")
+                    ),
+                    response=response,
+                )
+
+        response = view(request, *args, **kwargs)
+        if response.status_code != 200 or request.method != "GET":
+            return response
+
+        def store(response):
+            # The session and CSRF middleware only add their cookies
+            # after this runs, so what makes them do it is checked too.
+            session = getattr(request, "session", None)
+            if (
+                response.cookies
+                or (session is not None and session.modified)
+                or request.META.get("CSRF_COOKIE_USED")
+            ):
+                return
+            versions = get_versions(getattr(response, "page_tags", []))
+            cache.set(key, (versions, response), PAGE_CACHE_TIMEOUT)
+
+        if getattr(response, "is_rendered", True):
+            store(response)
+        else:
+            response.add_post_render_callback(store)
+        return response
+
+    return wrapper
+
+
+class PageTagsMixin:
+    """Tags the responses of a template view for cache_anonymous_page."""
+
+    def get_page_tags(self, context):
+        return []
+
+    def render_to_response(self, context, **response_kwargs):
+        response = super().render_to_response(context, **response_kwargs)
+        response.page_tags = self.get_page_tags(context)
+        return response
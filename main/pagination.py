@@ -0,0 +1,193 @@
+import base64
+import json
+from collections import OrderedDict
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPage:
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        if self._has_next and self.object_list:
+            return self.paginator.encode_cursor("n", self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self._has_previous and self.object_list:
+            return self.paginator.encode_cursor("p", self.object_list[0])
+
+
+class KeysetPaginator:
+    """
+    Paginates a queryset on the values of its ordering fields instead
+    of an OFFSET, so every page costs the same index range scan and no
+    COUNT(*) is needed. The last ordering field must be unique.
+
+    Cursors are opaque strings holding the direction and the ordering
+    values of the first or last row of the page they come from.
+    """
+
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.ordering = ordering
+        self.per_page = per_page
+        self.fields = [
+            (name.lstrip("-"), name.startswith("-")) for name in ordering
+        ]
+
+    def page(self, cursor=None):
+        if cursor:
+            direction, values = self.decode_cursor(cursor)
+        else:
+            direction, values = "n", None
+
+        queryset = self.queryset
+        if direction == "n":
+            ordering = self.ordering
+        else:
+            ordering = [
+                name[1:] if name.startswith("-") else "-" + name
+                for name in self.ordering
+            ]
+        if values is not None:
+            queryset = queryset.filter(
+                self.seek_filter(values, forward=direction == "n")
+            )
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == "n":
+            return KeysetPage(rows, self, more, values is not None)
+        rows.reverse()
+        return KeysetPage(rows, self, True, more)
+
+    def seek_filter(self, values, forward):
+        # (a, b) > (x, y) becomes a > x OR (a = x AND b > y), with the
+        # comparison flipped for descending fields and backward seeks.
+        q = Q()
+        for i, (name, descending) in enumerate(self.fields):
+            lookup = "lt" if descending == forward else "gt"
+            condition = Q(**{"%s__%s" % (name, lookup): values[i]})
+            for j, (prefix_name, _) in enumerate(self.fields[:i]):
+                condition &= Q(**{prefix_name: values[j]})
+            q |= condition
+        return q
+
+    def get_field(self, name):
+        model = self.queryset.model
+        *path, last = name.split("__")
+        for part in path:
+            model = model._meta.get_field(part).related_model
+        return model._meta.get_field(last)
+
+    def encode_cursor(self, direction, obj):
+        values = []
+        for name, _ in self.fields:
+            value = obj
+            for part in name.split("__"):
+                value = getattr(value, part)
+            field = self.get_field(name)
+            values.append(field.to_python(value))
+        data = json.dumps([direction, values], cls=CursorEncoder)
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            direction, raw = json.loads(
+                base64.urlsafe_b64decode(cursor.encode()).decode()
+            )
+            if direction not in ("n", "p") or len(raw) != len(self.fields):
+                raise ValueError("Invalid cursor")
+            values = [
+                self.get_field(name).to_python(value)
+                for (name, _), value in zip(self.fields, raw)
+            ]
+        except (ValueError, TypeError, ValidationError) as e:
+            raise ValueError("Invalid cursor") from e
+        return direction, values
+
+    def estimated_count(self):
+        """Row estimate of the planner, without running the query."""
+        sql, params = self.queryset.query.sql_with_params()
+        with connections[self.queryset.db].cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class CursorEncoder(json.JSONEncoder):
+    def default(self, o):
+        if hasattr(o, "isoformat"):
+            return o.isoformat()
+        return str(o)
+
+
+class KeysetPagination(pagination.BasePagination):
+    """
+    DRF counterpart of KeysetPaginator. Views set keyset_ordering, and
+    clients can ask for an estimated total with ?estimate=1.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    estimate_query_param = "estimate"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.paginator = KeysetPaginator(
+            queryset, view.keyset_ordering, self.page_size
+        )
+        try:
+            self.page = self.paginator.page(
+                request.query_params.get(self.cursor_query_param)
+            )
+        except ValueError:
+            raise NotFound("Invalid cursor")
+        return list(self.page)
+
+    def get_link(self, cursor):
+        if cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def get_paginated_response(self, data):
+        content = OrderedDict(
+            [
+                ("next", self.get_link(self.page.next_cursor)),
+                ("previous", self.get_link(self.page.previous_cursor)),
+            ]
+        )
+        if self.request.query_params.get(self.estimate_query_param):
+            content["estimated_count"] = self.paginator.estimated_count()
+        content["results"] = data
+        return Response(content)
@@ -0,0 +1,168 @@
+import os
+import re
+import tempfile
+from django.conf import settings
+from django.urls import reverse
+from main.storage import media_storage
+
+# Widths served on demand: any multiple of WIDTH_STEP up to MAX_WIDTH,
+# so that the number of files one image can have in the cache is bounded.
+WIDTH_STEP = 50
+MAX_WIDTH = 2400
+
+CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+SOURCE_DIRECTORY = "product-images"
+
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_valid(width, format):
+    return (
+        format in CONTENT_TYPES
+        and 0 < width <= MAX_WIDTH
+        and width % WIDTH_STEP == 0
+    )
+
+
+def image_digest(name):
+    """The content hash in a content-addressed image name, or None."""
+    root, _ = os.path.splitext(os.path.basename(name))
+    return root if DIGEST_RE.match(root) else None
+
+
+def url(name, width, format):
+    return reverse(
+        "image_rendition",
+        kwargs={
+            "digest": image_digest(name),
+            "width": width,
+            "format": format,
+        },
+    )
+
+
+def source_name(digest):
+    """Name of the product image with content hash digest, or None."""
+    directory = "%s/%s" % (SOURCE_DIRECTORY, digest[:2])
+    if not media_storage.exists(directory):
+        return None
+    _, files = media_storage.listdir(directory)
+    for name in files:
+        if os.path.splitext(name)[0] == digest:
+            return "%s/%s" % (directory, name)
+    return None
+
+
+class DiskCache:
+    """
+    Files under root, evicted least recently used first once they
+    take more than max_size bytes. Recency is the modification time,
+    which get() bumps, so nothing but the directory is needed to keep
+    track of it and several processes can share the cache.
+
+    Scanning the directory is what eviction costs, so it is done only
+    once the bytes this process put since the last scan could have
+    taken the cache over max_size. Puts from other processes are not
+    counted, which lets the cache grow past max_size by up to
+    1 - LOW_WATER of it per process.
+    """
+
+    # Eviction goes below the limit, leaving room for puts until the
+    # next scan
+    LOW_WATER = 0.9
+
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        # Size of the cache as of the last scan plus what was put
+        # since; None until the first scan.
+        self.size = None
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key):
+        """The file stored under key, open for reading, or None."""
+        try:
+            f = open(self.path(key), "rb")
+        except FileNotFoundError:
+            return None
+        # Once open, the file stays readable even if it is evicted
+        os.utime(f.fileno())
+        return f
+
+    def put(self, key, data):
+        """Stores data under key and returns the file, open for reading."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Readers never see a partly written file
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, "w+b")
+        f.write(data)
+        f.seek(0)
+        os.replace(temp, path)
+        if self.size is not None:
+            self.size += len(data)
+        if self.size is None or self.size > self.max_size:
+            self.evict()
+        return f
+
+    def entries(self):
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self):
+        entries = list(self.entries())
+        size = sum(entry[1] for entry in entries)
+        if size > self.max_size:
+            target = self.max_size * self.LOW_WATER
+            for _, entry_size, path in sorted(entries):
+                if size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                size -= entry_size
+        self.size = size
+
+
+# One cache per settings, so that its size is kept between requests
+_caches = {}
+
+
+def get_cache():
+    key = (settings.RENDITION_CACHE_ROOT, settings.RENDITION_CACHE_MAX_SIZE)
+    if key not in _caches:
+        _caches[key] = DiskCache(*key)
+    return _caches[key]
+
+
+def get_rendition(digest, width, format):
+    """
+    The width wide format rendition of the product image with content
+    hash digest as an open file, made and cached on first request. None
+    if there is no such image.
+    """
+    # Imported here as thumbnails imports the models
+    from main.thumbnails import make_rendition
+
+    cache = get_cache()
+    key = "%s-%d.%s" % (digest, width, format)
+    f = cache.get(key)
+    if f is not None:
+        return f
+    name = source_name(digest)
+    if name is None:
+        return None
+    with media_storage.open(name, "rb") as f:
+        data = f.read()
+    return cache.put(key, make_rendition(data, width, format))
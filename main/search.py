@@ -0,0 +1,45 @@
+from django.contrib.postgres.search import SearchVector
+from django.db.models import Func, TextField, Value
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+SEARCH_CONFIG = "english"
+
+# Control characters delimit the matches in headlines, so that the
+# text around them can be escaped before the markup is added.
+START_SEL = "\x02"
+STOP_SEL = "\x03"
+
+
+def product_search_vector(tag_names):
+    return (
+        SearchVector("name", weight="A", config=SEARCH_CONFIG)
+        + SearchVector(tag_names, weight="B", config=SEARCH_CONFIG)
+        + SearchVector("description", weight="C", config=SEARCH_CONFIG)
+    )
+
+
+class SearchHeadline(Func):
+    function = "ts_headline"
+    output_field = TextField()
+
+    def __init__(self, expression, query, **kwargs):
+        super().__init__(
+            Value(SEARCH_CONFIG),
+            expression,
+            query,
+            Value(
+                "StartSel=%s, StopSel=%s, MaxWords=30, MinWords=10"
+                % (START_SEL, STOP_SEL)
+            ),
+            **kwargs
+        )
+
+
+def format_headline(headline):
+    """HTML for a headline, with the matches wrapped in <mark>."""
+    return mark_safe(
+        escape(headline)
+        .replace(START_SEL, "<mark>")
+        .replace(STOP_SEL, "</mark>")
+    )
@@ -1,64 +1,89 @@
-from io import BytesIO
 import logging
-from PIL import Image
-from django.core.files.base import ContentFile
-from django.db.models.signals import pre_save, post_save
+from django.db.models import F
+from django.db.models.signals import (
+    pre_save, post_save, post_init, pre_delete, post_delete, m2m_changed
+)
+from django.utils import timezone
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
+from . import pagecache, thumbnails
+from .baskets import SessionBasket
 from .models import (
-    ProductImage, Basket, OrderLine, Order
+    ProductImage, Basket, OrderLine, Order, User, Product, ProductTag,
+    ThumbnailJob,
 )
 
-THUMBNAIL_SIZE = (300, 300)
-
 logger = logging.getLogger(__name__)
 
 
+@receiver(post_init, sender=ProductImage)
+def remember_productimage_name(sender, instance, **kwargs):
+    image = instance.__dict__.get("image")
+    instance._loaded_image = getattr(image, "name", image)
+
+
 @receiver(pre_save, sender=ProductImage)
-def generate_thumbnail(sender, instance, **kwargs):
-    """
-
-    :param sender:
-    :param instance:
-    :type instance ProductImage
-    :param kwargs:
-    :return:
-    """
-    logger.info(
-        "Generating thumbnail for product %d",
-        instance.product.id,
-    )
-    image = Image.open(instance.image)
-    image = image.convert("RGB")
-    image.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
-
-    temp_thumb = BytesIO()
-    image.save(temp_thumb, "JPEG")
-    temp_thumb.seek(0)
-
-    instance.thumbnail.save(
-        instance.image.name,
-        ContentFile(temp_thumb.read()),
-        save=False,
+def reset_thumbnail(sender, instance, raw=False, **kwargs):
+    # Saves that keep the same source image keep their thumbnail
+    image = instance.image
+    instance._image_changed = (
+        instance._state.adding
+        or not image._committed
+        or image.name != instance._loaded_image
     )
-    temp_thumb.close()
+    if instance._image_changed and not raw:
+        instance.thumbnail = None
+
+
+@receiver(post_save, sender=ProductImage)
+def enqueue_thumbnail(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if instance._image_changed:
+        if not created:
+            instance.renditions.all().delete()
+        if thumbnails.reuse_renditions(instance):
+            logger.info(
+                "Reused thumbnail for product %d", instance.product_id
+            )
+            instance._image_changed = False
+    if instance._image_changed or not instance.thumbnail:
+        logger.info(
+            "Queueing thumbnail for product %d", instance.product_id
+        )
+        ThumbnailJob.objects.enqueue(instance)
+    instance._loaded_image = instance.image.name
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def touch_product(sender, instance, raw=False, **kwargs):
+    # Moves the key the product page caches its image list under
+    if not raw:
+        Product.objects.filter(pk=instance.product_id).update(
+            date_updated=timezone.now()
+        )
+        pagecache.purge(pagecache.product_tag(instance.product_id))
 
 
 @receiver(user_logged_in)
 def merge_baskets_if_found(sender, user, request, **kwargs):
     anonymous_basket = getattr(request, "basket", None)
-    if anonymous_basket:
-        try:
-            logged_in_basket = Basket.objects.get(
-                user=user, status=Basket.OPEN
-            )
-            for line in anonymous_basket.basketline_set.all():
-                line.basket = logged_in_basket
-                line.save()
-            anonymous_basket.delete()
+    if isinstance(anonymous_basket, SessionBasket):
+        request.basket = anonymous_basket.save_to_db(user)
+    elif anonymous_basket:
+        logged_in_basket = (
+            Basket.objects.filter(user=user, status=Basket.OPEN)
+            .exclude(pk=anonymous_basket.pk)
+            .order_by("id")
+            .first()
+        )
+        if logged_in_basket:
+            logged_in_basket.merge(anonymous_basket)
             request.basket = logged_in_basket
+            request.session["basket_id"] = logged_in_basket.id
             logger.info("Merged basked to id %d", logged_in_basket.id)
-        except Basket.DoesNotExist:
+        else:
             anonymous_basket.user = user
             anonymous_basket.save()
             logger.info(
@@ -67,12 +92,251 @@ def merge_baskets_if_found(sender, user, request, **kwargs):
             )
 
 
+@receiver(post_save, sender=Product)
+def product_to_search_vector(sender, instance, raw=False, **kwargs):
+    if not raw:
+        Product.objects.update_search_vector([instance.pk])
+
+
+@receiver(post_init, sender=ProductTag)
+def remember_producttag_name(sender, instance, **kwargs):
+    instance._loaded_name = instance.__dict__.get("name")
+
+
+@receiver(post_save, sender=ProductTag)
+def producttag_to_search_vector(sender, instance, created, raw=False,
+                                **kwargs):
+    # Only the name is in the vectors, and rebuilding them moves the
+    # date of every product under the tag
+    renamed = instance._loaded_name != instance.name
+    instance._loaded_name = instance.name
+    if renamed and not created and not raw:
+        Product.objects.update_search_vector(
+            instance.product_set.values("pk")
+        )
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_to_search_vector(sender, instance, action, reverse,
+                                  pk_set, **kwargs):
+    if reverse and action == "pre_clear":
+        # post_clear does not report which products lost the tag
+        instance._cleared_products = list(
+            instance.product_set.values_list("pk", flat=True)
+        )
+    elif action in ("post_add", "post_remove"):
+        products = pk_set if reverse else [instance.pk]
+        Product.objects.update_search_vector(products)
+    elif action == "post_clear":
+        if reverse:
+            products = instance.__dict__.pop("_cleared_products", [])
+        else:
+            products = [instance.pk]
+        Product.objects.update_search_vector(products)
+
+
+@receiver(pre_delete, sender=ProductTag)
+def remember_tagged_products(sender, instance, **kwargs):
+    # The M2M rows are gone by post_delete
+    instance._tagged_products = list(
+        instance.product_set.values_list("pk", flat=True)
+    )
+
+
+@receiver(post_delete, sender=ProductTag)
+def producttag_delete_to_search_vector(sender, instance, **kwargs):
+    products = instance.__dict__.pop("_tagged_products", [])
+    if products:
+        Product.objects.update_search_vector(products)
+
+
+@receiver(post_save, sender=Product)
+def product_to_catalog(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    tags = []
+    if not created:
+        tags = list(instance.tags.values_list("slug", flat=True))
+    pagecache.purge_products([instance], tags)
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_tags(sender, instance, **kwargs):
+    # The M2M rows are gone by post_delete
+    instance._catalog_tags = list(
+        instance.tags.values_list("slug", flat=True)
+    )
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_baskets(sender, instance, **kwargs):
+    # The basket lines of the product are deleted with it, so the
+    # counts of their baskets go down by their quantities.
+    instance._basket_ids = list(
+        Basket.objects.filter(basketline__product=instance)
+        .values_list("id", flat=True)
+        .distinct()
+    )
+
+
+@receiver(post_delete, sender=Product)
+def product_delete_to_baskets(sender, instance, **kwargs):
+    basket_ids = instance.__dict__.pop("_basket_ids", [])
+    if basket_ids:
+        Basket.objects.filter(pk__in=basket_ids).refresh_item_counts()
+
+
+@receiver(post_delete, sender=Product)
+def product_delete_to_catalog(sender, instance, **kwargs):
+    tags = instance.__dict__.pop("_catalog_tags", [])
+    pagecache.purge_products([instance], tags)
+
+
+@receiver(post_init, sender=ProductTag)
+def remember_producttag_slug(sender, instance, **kwargs):
+    instance._loaded_slug = instance.__dict__.get("slug")
+
+
+@receiver(post_save, sender=ProductTag)
+def producttag_to_catalog(sender, instance, created, **kwargs):
+    slugs = {instance._loaded_slug, instance.slug} - {None}
+    instance._loaded_slug = instance.slug
+    pagecache.purge(
+        *[pagecache.tag_tag(slug) for slug in slugs],
+        *[pagecache.catalog_tag(slug) for slug in slugs]
+    )
+
+
+@receiver(post_delete, sender=ProductTag)
+def producttag_delete_to_catalog(sender, instance, **kwargs):
+    pagecache.purge(
+        pagecache.tag_tag(instance.slug),
+        pagecache.catalog_tag(instance.slug),
+    )
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def product_tags_to_catalog(sender, instance, action, reverse, pk_set,
+                            **kwargs):
+    if action not in ("pre_clear", "post_add", "post_remove",
+                      "post_clear"):
+        return
+    if reverse:
+        if action == "pre_clear":
+            return
+        # Product pages showing the tag are tagged with it
+        pagecache.purge(
+            pagecache.tag_tag(instance.slug),
+            pagecache.catalog_tag(instance.slug),
+            *[pagecache.product_tag(pk) for pk in pk_set or ()]
+        )
+    elif action == "pre_clear":
+        instance._catalog_tags = list(
+            instance.tags.values_list("slug", flat=True)
+        )
+    else:
+        if action == "post_clear":
+            tags = instance.__dict__.pop("_catalog_tags", [])
+        else:
+            tags = ProductTag.objects.filter(pk__in=pk_set).values_list(
+                "slug", flat=True
+            )
+        pagecache.purge(
+            pagecache.product_tag(instance.pk),
+            *[pagecache.catalog_tag(tag) for tag in tags]
+        )
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_group_names(sender, instance, **kwargs):
+    if isinstance(instance, User):
+        instance.__dict__.pop("group_names", None)
+
+
+@receiver(post_init, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    # Order.save() only writes the status when it was changed
+    instance._loaded_status = instance.__dict__.get("status")
+
+
+@receiver(post_init, sender=OrderLine)
+def remember_orderline_status(sender, instance, **kwargs):
+    # The status the line had when loaded, so that saves that leave it
+    # alone do not need to query.
+    instance._loaded_status = instance.__dict__.get("status")
+
+
+@receiver(pre_save, sender=OrderLine)
+def lock_orderline_status_for_save(
+    sender, instance, update_fields=None, **kwargs
+):
+    # Another process may have moved the line since it was loaded, so
+    # the status it leaves is the one in the row. OrderLine.save()
+    # runs in a transaction: the lock holds until the counters are
+    # updated.
+    instance._previous_status = None
+    if instance._state.adding or instance.pk is None:
+        return
+    if update_fields is not None and "status" not in update_fields:
+        instance._previous_status = instance.status
+        return
+    instance._previous_status = (
+        OrderLine.objects.select_for_update()
+        .filter(pk=instance.pk)
+        .values_list("status", flat=True)
+        .first()
+    )
+
+
 @receiver(post_save, sender=OrderLine)
-def orderline_to_order_status(sender, instance, **kwargs):
-    if not instance.order.lines.filter(status__lt=OrderLine.SENT).exists():
-        logger.info(
-            "All lines for order %d have been processed."
-            "Marking as done. ", instance.order.id,
+def orderline_to_order_status(sender, instance, created, **kwargs):
+    previous = None if created else instance._previous_status
+    current = instance.status
+    instance._loaded_status = current
+    if previous == current:
+        return
+
+    field = OrderLine.COUNTER_FIELDS[current]
+    counters = {field: F(field) + 1}
+    if previous is not None:
+        field = OrderLine.COUNTER_FIELDS[previous]
+        counters[field] = F(field) - 1
+    orders = Order.objects.filter(pk=instance.order_id)
+    orders.update(date_updated=timezone.now(), **counters)
+
+    if current >= OrderLine.SENT and (
+        previous is None or previous < OrderLine.SENT
+    ):
+        marked = orders.filter(
+            new_lines=0, processing_lines=0
+        ).exclude(status=Order.DONE).update(
+            status=Order.DONE, date_updated=timezone.now()
         )
-        instance.order.status = Order.DONE
-        instance.order.save()
+        if marked:
+            logger.info(
+                "All lines for order %d have been processed."
+                "Marking as done. ", instance.order_id,
+            )
+
+
+@receiver(pre_delete, sender=OrderLine)
+def lock_orderline_status(sender, instance, **kwargs):
+    # Deletes run in a transaction: the lock holds until the row is
+    # gone, so no status change can slip in between.
+    instance._loaded_status = (
+        OrderLine.objects.select_for_update()
+        .filter(pk=instance.pk)
+        .values_list("status", flat=True)
+        .first()
+    )
+
+
+@receiver(post_delete, sender=OrderLine)
+def orderline_delete_to_order_counters(sender, instance, **kwargs):
+    status = instance._loaded_status
+    if status is None:
+        return
+    field = OrderLine.COUNTER_FIELDS[status]
+    Order.objects.filter(pk=instance.order_id).update(
+        date_updated=timezone.now(), **{field: F(field) - 1}
+    )
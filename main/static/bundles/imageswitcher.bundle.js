@@ -93,7 +93,7 @@
 /*! no static exports found */
 /***/ (function(module, exports, __webpack_require__) {
 
-eval("const React = __webpack_require__(/*! react */ \"./node_modules/react/index.js\");\nconst ReactDOM = __webpack_require__(/*! react-dom */ \"./node_modules/react-dom/index.js\");\nconst e = React.createElement;\n\nvar imageStyle = {\n    margin: \"10px\",\n    display: \"inline-block\"\n};\n\nclass ImageBox extends React.Component {\n    constructor(props) {\n        super(props);\n        this.state = {\n            currentImage: this.props.imageStart\n        }\n    }\n\n    click(image) {\n        this.setState({\n            currentImage: image\n        });\n    }\n\n    render() {\n        const images = this.props.images.map((i) =>\n            e('div', {\n                    style: imageStyle, className: \"image\", key: i.image\n                },\n                e('img', {\n                    onClick: this.click.bind(this, i),\n                    width: \"100\", src: i.thumbnail\n                })\n            )\n        );\n        return e('div', {className: \"gallery\"},\n            e('div', {className: \"current-image\"},\n                e('img', {src: this.state.currentImage.image})\n            ),\n            images)\n    }\n}\n\nwindow.React = React;\nwindow.ReactDOM = ReactDOM;\nwindow.ImageBox = ImageBox;\nmodule.exports = ImageBox;\n\n//# sourceURL=webpack:///./frontend/imageswitcher.js?");
+eval("const React = __webpack_require__(/*! react */ \"./node_modules/react/index.js\");\nconst ReactDOM = __webpack_require__(/*! react-dom */ \"./node_modules/react-dom/index.js\");\nconst e = React.createElement;\n\n// Browsers pick the smallest rendition of the srcsets that fills this\nvar currentImageSizes = \"(max-width: 600px) 100vw, 600px\";\n\nvar imageStyle = {\n    margin: \"10px\",\n    display: \"inline-block\"\n};\n\nclass ImageBox extends React.Component {\n    constructor(props) {\n        super(props);\n        this.state = {\n            currentImage: this.props.imageStart\n        }\n    }\n\n    click(image) {\n        this.setState({\n            currentImage: image\n        });\n    }\n\n    render() {\n        const images = this.props.images.map((i) =>\n            e('div', {\n                    style: imageStyle, className: \"image\", key: i.image\n                },\n                e('img', {\n                    onClick: this.click.bind(this, i),\n                    width: \"100\", src: i.thumbnail,\n                    srcSet: i.srcset || undefined,\n                    sizes: \"100px\"\n                })\n            )\n        );\n        const current = this.state.currentImage;\n        return e('div', {className: \"gallery\"},\n            e('picture', {className: \"current-image\"},\n                current.webp_srcset ? e('source', {\n                    type: \"image/webp\",\n                    srcSet: current.webp_srcset,\n                    sizes: currentImageSizes\n                }) : null,\n                e('img', {\n                    src: current.image,\n                    srcSet: current.srcset || undefined,\n                    sizes: currentImageSizes\n                })\n            ),\n            images)\n    }\n}\n\nwindow.React = React;\nwindow.ReactDOM = ReactDOM;\nwindow.ImageBox = ImageBox;\nmodule.exports = ImageBox;\n\n//# sourceURL=webpack:///./frontend/imageswitcher.js?");
 
 /***/ }),
 
@@ -0,0 +1,64 @@
+import hashlib
+import os
+import uuid
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+def content_hash(content):
+    sha = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        sha.update(chunk)
+    content.seek(0)
+    return sha.hexdigest()
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores files under the SHA-256 of their content, in the directory
+    upload_to gives, so identical files are written once and share a
+    name. Only the extension of the original name is kept.
+    """
+
+    def content_name(self, name, content):
+        digest = content_hash(content)
+        extension = os.path.splitext(name)[1].lower()
+        return os.path.join(
+            os.path.dirname(name), digest[:2], digest + extension
+        )
+
+    def _save(self, name, content):
+        name = self.content_name(name, content)
+        try:
+            # A new reference to an old file, which gc_media must not
+            # take for an orphan before the row referring to it is saved
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            pass
+        # Written under a temporary name and linked into place, so that
+        # a file is never seen half written and concurrent saves of the
+        # same content all end up with this name.
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = "%s.%s.tmp" % (path, uuid.uuid4().hex)
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in content.chunks():
+                    f.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp, self.file_permissions_mode)
+            try:
+                os.link(temp, path)
+            except FileExistsError:
+                # Saved meanwhile by another process
+                pass
+        finally:
+            os.remove(temp)
+        return name
+
+
+media_storage = ContentAddressedStorage()
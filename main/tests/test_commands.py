@@ -1,10 +1,15 @@
 import os
 from io import StringIO
 import tempfile
+from datetime import timedelta
 from django.conf import settings
+from django.core.files.images import ImageFile
 from django.core.management import call_command
-from django.test import TestCase, override_settings
-from main import models
+import shutil
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from unittest.mock import patch
+from main import factories, models, thumbnails
 
 
 class TestImport(TestCase):
@@ -26,3 +31,349 @@ class TestImport(TestCase):
         self.assertEqual(models.Product.objects.count(), 3)
         self.assertEqual(models.ProductTag.objects.count(), 6)
         self.assertEqual(models.ProductImage.objects.count(), 3)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_data_twice_reuses_images(self):
+        args = ['main/fixtures/product-sample.csv',
+                'main/fixtures/product-sampleimages/']
+        for run in range(2):
+            call_command('import_data', *args, stdout=StringIO())
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+        self.assertEqual(
+            len(os.listdir(os.path.join(settings.MEDIA_ROOT, "product-images"))),
+            3,
+        )
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_data_bulk(self):
+        args = ['main/fixtures/product-sample.csv',
+                'main/fixtures/product-sampleimages/',
+                '--bulk', '--chunk-size=2', '--workers=1']
+        models.ProductTag.objects.create(name="Games", slug="games")
+        out = StringIO()
+        call_command('import_data', *args, stdout=out)
+        self.assertEqual(
+            out.getvalue(),
+            "Importing products\n"
+            "Products processed=3 (created=3)\n"
+            "Tags processed=6 (created=5)\n"
+            "Images processed=3\n",
+        )
+        cb = models.Product.objects.get(name="The cathedral and the bazaar")
+        self.assertEqual(cb.slug, "the-cathedral-and-the-bazaar")
+        self.assertEqual(
+            sorted(cb.tags.values_list("slug", flat=True)),
+            ["open-source", "programming"],
+        )
+        self.assertEqual(
+            list(models.Product.objects.search("programming")), [cb]
+        )
+        # Resized during the import, not queued
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+        image = cb.productimage_set.get()
+        self.assertTrue(image.thumbnail)
+        self.assertTrue(os.path.exists(image.thumbnail.path))
+        self.assertTrue(image.renditions.exists())
+
+        # Same rows again: nothing new and nothing resized. Four
+        # lookups up front, then seven statements per chunk however
+        # many rows it has.
+        out = StringIO()
+        with self.assertNumQueries(4 + 7 * 2), patch(
+            "main.thumbnails.make_renditions"
+        ) as make_renditions:
+            call_command('import_data', *args, stdout=out)
+        make_renditions.assert_not_called()
+        self.assertIn("Products processed=3 (created=0)", out.getvalue())
+        self.assertEqual(models.Product.objects.count(), 3)
+        self.assertEqual(models.ProductTag.objects.count(), 6)
+        self.assertEqual(models.ProductImage.objects.count(), 3)
+        self.assertEqual(cb.tags.count(), 2)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_data_tags_with_the_same_slug(self):
+        csvfile = os.path.join(tempfile.mkdtemp(), "products.csv")
+        with open(csvfile, "w") as f:
+            f.write(
+                "name,description,tags,image_filename,price\n"
+                "First,A book,Open Source|Linux,siddhartha.jpg,1.00\n"
+                "Second,A book,open source|GNU Linux,siddhartha.jpg,2.00\n"
+            )
+        models.ProductTag.objects.create(name="GNU/Linux", slug="gnu-linux")
+        for options in ([], ["--bulk", "--workers=1"]):
+            models.Product.objects.all().delete()
+            call_command(
+                "import_data", csvfile,
+                "main/fixtures/product-sampleimages/", *options,
+                stdout=StringIO(),
+            )
+            self.assertEqual(
+                sorted(models.ProductTag.objects.values_list("slug", "name")),
+                [
+                    ("gnu-linux", "GNU/Linux"),
+                    ("linux", "Linux"),
+                    ("open-source", "Open Source"),
+                ],
+            )
+            second = models.Product.objects.get(name="Second")
+            self.assertEqual(
+                sorted(second.tags.values_list("slug", flat=True)),
+                ["gnu-linux", "open-source"],
+            )
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_data_bulk_shares_earlier_renditions(self):
+        with open(
+            "main/fixtures/product-sampleimages/cathedral-bazaar.jpg", "rb"
+        ) as f:
+            earlier = models.ProductImage.objects.create(
+                product=factories.ProductFactory(),
+                image=ImageFile(f, name="earlier.jpg"),
+            )
+        call_command("process_thumbnails", "--once", "--workers=1",
+                     stdout=StringIO())
+        earlier.refresh_from_db()
+
+        with patch(
+            "main.thumbnails.make_renditions",
+            wraps=thumbnails.make_renditions,
+        ) as make_renditions:
+            call_command(
+                "import_data",
+                "main/fixtures/product-sample.csv",
+                "main/fixtures/product-sampleimages/",
+                "--bulk", "--workers=1", stdout=StringIO(),
+            )
+        # Only the two other files are resized
+        self.assertEqual(make_renditions.call_count, 2)
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+        image = models.ProductImage.objects.get(
+            product__name="The cathedral and the bazaar"
+        )
+        self.assertEqual(image.image.name, earlier.image.name)
+        self.assertEqual(image.thumbnail.name, earlier.thumbnail.name)
+        self.assertEqual(
+            sorted(image.renditions.values_list("width", "format", "file")),
+            sorted(
+                earlier.renditions.values_list("width", "format", "file")
+            ),
+        )
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_gc_media(self):
+        product = factories.ProductFactory()
+        images = []
+        for name in ("cathedral-bazaar.jpg", "siddhartha.jpg"):
+            with open(
+                "main/fixtures/product-sampleimages/" + name, "rb"
+            ) as f:
+                images.append(
+                    models.ProductImage.objects.create(
+                        product=product, image=ImageFile(f, name=name)
+                    )
+                )
+        call_command("process_thumbnails", "--once", "--workers=1",
+                     stdout=StringIO())
+        kept = models.ProductImage.objects.get(pk=images[0].pk)
+        orphans = 2 + images[1].renditions.count()
+        images[1].delete()
+
+        out = StringIO()
+        call_command("gc_media", "--dry-run", stdout=out)
+        self.assertEqual(out.getvalue(), "Would delete files=0 bytes=0\n")
+        out = StringIO()
+        call_command("gc_media", "--min-age=0", stdout=out)
+        self.assertTrue(
+            out.getvalue().startswith("Deleted files=%d " % orphans)
+        )
+        self.assertFalse(os.path.exists(images[1].image.path))
+        self.assertTrue(os.path.exists(kept.image.path))
+        self.assertTrue(os.path.exists(kept.thumbnail.path))
+        for rendition in kept.renditions.all():
+            self.assertTrue(os.path.exists(rendition.file.path))
+
+    def test_reap_baskets(self):
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        product = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            price="10.00",
+        )
+        old = timezone.now() - timedelta(days=60)
+        stale = models.Basket.objects.create()
+        submitted = models.Basket.objects.create(
+            user=user, status=models.Basket.SUBMITTED
+        )
+        fresh = models.Basket.objects.create(user=user)
+        for basket in (stale, submitted, fresh):
+            models.BasketLine.objects.create(basket=basket, product=product)
+        models.Basket.objects.filter(
+            id__in=[stale.id, submitted.id]
+        ).update(date_updated=old)
+
+        out = StringIO()
+        call_command("reap_baskets", "--dry-run", stdout=out)
+        self.assertIn("Would delete open baskets=1\n", out.getvalue())
+        self.assertEqual(models.Basket.objects.count(), 3)
+
+        out = StringIO()
+        call_command(
+            "reap_baskets", "--batch-size=1", "--sleep=0", stdout=out
+        )
+        self.assertIn("Deleted open baskets=1\n", out.getvalue())
+        self.assertIn("Deleted submitted baskets=1\n", out.getvalue())
+        self.assertEqual(
+            list(models.Basket.objects.all()), [fresh]
+        )
+        self.assertEqual(models.BasketLine.objects.count(), 1)
+
+        # A basket used after it was picked is kept
+        batches = [[fresh.id]]
+        out = StringIO()
+        with patch(
+            "main.management.commands.reap_baskets.Command.pick_batch",
+            side_effect=lambda queryset: batches.pop() if batches else [],
+        ):
+            call_command("reap_baskets", "--sleep=0", stdout=out)
+        self.assertIn("Deleted open baskets=0\n", out.getvalue())
+        self.assertEqual(list(models.Basket.objects.all()), [fresh])
+        self.assertEqual(models.BasketLine.objects.count(), 1)
+
+    # Checkouts count their orders once committed, which test
+    # transactions never are
+    @patch("django.db.transaction.on_commit", lambda func: func())
+    def test_rebuild_recommendations(self):
+        user = factories.UserFactory()
+        address = factories.AddressFactory(user=user)
+        products = factories.ProductFactory.create_batch(4)
+        for basket_products in (
+            products[:3], products[1:], products[:2], products[2:3]
+        ):
+            basket = models.Basket.objects.create(user=user)
+            for product in basket_products:
+                models.BasketLine.objects.create(
+                    basket=basket, product=product
+                )
+            basket.create_order(address, address)
+
+        def tables():
+            return (
+                sorted(
+                    models.CoPurchase.objects.values_list(
+                        "product", "other", "count"
+                    )
+                ),
+                sorted(
+                    models.Recommendation.objects.values_list(
+                        "product", "recommended", "score"
+                    )
+                ),
+            )
+
+        incremental = tables()
+        models.Recommendation.objects.all().delete()
+        out = StringIO()
+        call_command(
+            "rebuild_recommendations", "--chunk-size=2", stdout=out
+        )
+        self.assertEqual(tables(), incremental)
+        self.assertEqual(out.getvalue().count("Counted orders"), 2)
+        self.assertIn(
+            "Rebuilt recommendations=%d\n" % len(incremental[1]),
+            out.getvalue(),
+        )
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_process_thumbnails(self):
+        product = factories.ProductFactory()
+        for name in ("front.jpg", "back.jpg"):
+            with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+                models.ProductImage.objects.create(
+                    product=product, image=ImageFile(f, name=name)
+                )
+
+        out = StringIO()
+        call_command(
+            "process_thumbnails", "--once", "--workers=1", stdout=out
+        )
+        self.assertEqual(out.getvalue(), "Processed thumbnails=2\n")
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+        for image in models.ProductImage.objects.all():
+            self.assertTrue(image.thumbnail)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_regenerate_thumbnails(self):
+        products = factories.ProductFactory.create_batch(2)
+        for product, name in zip(products * 2, "abcd"):
+            with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+                models.ProductImage.objects.create(
+                    product=product, image=ImageFile(f, name=name + ".jpg")
+                )
+        models.ThumbnailJob.objects.all().delete()
+        images = list(models.ProductImage.objects.order_by("id"))
+
+        out = StringIO()
+        call_command(
+            "regenerate_thumbnails", "--workers=1", "--batch-size=3",
+            "--start-after=%d" % images[0].id, stdout=out,
+        )
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "Done up to id=%d" % images[3].id)
+        self.assertRegex(
+            lines[1],
+            r"^Regenerated thumbnails=3 failed=0 in [0-9.]+s "
+            r"\([0-9.]+ images/s\)$",
+        )
+        for image in images:
+            image.refresh_from_db()
+        # Images up to --start-after are skipped
+        self.assertFalse(images[0].thumbnail)
+        self.assertFalse(images[0].renditions.exists())
+        for image in images[1:]:
+            self.assertTrue(image.thumbnail)
+            # Widths above the source are made once, at its own width
+            self.assertEqual(image.renditions.count(), 6)
+
+
+class TestImportWorkers(TransactionTestCase):
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_import_data_bulk_with_workers(self):
+        # Three rows of one picture: twice the same file, which is
+        # stored once, and a copy under another name, which two
+        # workers store at the same time.
+        basedir = tempfile.mkdtemp()
+        for name in ("same.jpg", "copy.jpg"):
+            shutil.copy(
+                "main/fixtures/product-sampleimages/siddhartha.jpg",
+                os.path.join(basedir, name),
+            )
+        csvfile = os.path.join(basedir, "products.csv")
+        with open(csvfile, "w") as f:
+            f.write(
+                "name,description,tags,image_filename,price\n"
+                "First,A book,Novel,same.jpg,1.00\n"
+                "Second,A book,Novel,same.jpg,2.00\n"
+                "Third,A book,Novel,copy.jpg,3.00\n"
+            )
+        out = StringIO()
+        call_command(
+            "import_data", csvfile, basedir, "--bulk", "--workers=2",
+            stdout=out,
+        )
+        self.assertIn("Images processed=3", out.getvalue())
+        images = models.ProductImage.objects.all()
+        self.assertEqual(len(images), 3)
+        self.assertEqual(len({image.image.name for image in images}), 1)
+        renditions = {
+            tuple(sorted(image.renditions.values_list("file", flat=True)))
+            for image in images
+        }
+        self.assertEqual(len(renditions), 1)
+        self.assertEqual(len({image.thumbnail.name for image in images}), 1)
+        self.assertTrue(images[0].thumbnail)
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+        stored = []
+        for directory, _, files in os.walk(settings.MEDIA_ROOT):
+            stored.extend(files)
+        # One image, one thumbnail and the renditions, with no
+        # duplicate or leftover temporary file
+        self.assertEqual(len(stored), 2 + len(renditions.pop()))
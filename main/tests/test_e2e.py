@@ -1,6 +1,8 @@
 from decimal import Decimal
+import tempfile
 from django.urls import reverse
 from django.core.files.images import ImageFile
+from django.test import override_settings
 from django.contrib.staticfiles.testing import (
     StaticLiveServerTestCase
 )
@@ -8,6 +10,8 @@ from selenium.webdriver.firefox.webdriver import WebDriver
 from main import models
 
 
+# Uploads go to a throwaway directory, not the MEDIA_ROOT of the tree
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class FrontendTests(StaticLiveServerTestCase):
     @classmethod
     def setUpClass(cls):
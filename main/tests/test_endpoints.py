@@ -0,0 +1,172 @@
+from unittest.mock import patch
+from django.contrib.auth.models import Group, Permission
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework import serializers
+from main import factories
+from main import models
+from main.pagination import KeysetPagination
+
+
+class TestEndpoints(TestCase):
+    def setUp(self):
+        dispatchers = Group.objects.create(name="Dispatchers")
+        dispatchers.permissions.add(
+            Permission.objects.get(codename="change_orderline")
+        )
+        self.user = models.User.objects.create_user(
+            "dispatcher@booktime.domain", "pw432joij", is_staff=True
+        )
+        self.user.groups.add(dispatchers)
+
+    def test_bulk_transition_marks_orders_done(self):
+        product = factories.ProductFactory()
+        orders = factories.OrderFactory.create_batch(
+            2, status=models.Order.PAID
+        )
+        lines = factories.OrderLineFactory.create_batch(
+            3, order=orders[0], product=product
+        ) + factories.OrderLineFactory.create_batch(
+            2, order=orders[1], product=product
+        )
+        self.client.force_login(self.user)
+
+        response = self.client.post(
+            reverse("orderline-transition"),
+            {
+                "ids": [line.id for line in lines[:4]],
+                "status": models.OrderLine.SENT,
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["updated"], 4)
+
+        orders[0].refresh_from_db()
+        orders[1].refresh_from_db()
+        self.assertEqual(orders[0].status, models.Order.DONE)
+        self.assertEqual(orders[0].sent_lines, 3)
+        self.assertEqual(orders[1].status, models.Order.PAID)
+        self.assertEqual(orders[1].new_lines, 1)
+        self.assertEqual(orders[1].sent_lines, 1)
+
+    def test_bulk_transition_rejects_invalid_transitions(self):
+        product = factories.ProductFactory()
+        order = factories.OrderFactory(status=models.Order.PAID)
+        sent = factories.OrderLineFactory(
+            order=order, product=product, status=models.OrderLine.SENT
+        )
+        new = factories.OrderLineFactory(order=order, product=product)
+        self.client.force_login(self.user)
+
+        response = self.client.post(
+            reverse("orderline-transition"),
+            {
+                "ids": [sent.id, new.id],
+                "status": models.OrderLine.PROCESSING,
+            },
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        new.refresh_from_db()
+        self.assertEqual(new.status, models.OrderLine.NEW)
+
+    def test_paid_orders_keyset_pagination(self):
+        employees = Group.objects.create(name="Employees")
+        employees.permissions.add(
+            Permission.objects.get(codename="change_order")
+        )
+        self.user.groups.add(employees)
+        orders = factories.OrderFactory.create_batch(
+            3, status=models.Order.PAID
+        )
+        factories.OrderFactory(status=models.Order.NEW)
+        self.client.force_login(self.user)
+
+        with patch.object(KeysetPagination, "page_size", 2):
+            response = self.client.get(
+                reverse("order-list"), {"estimate": 1}
+            )
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertEqual(len(data["results"]), 2)
+            self.assertIsNone(data["previous"])
+            self.assertIn("estimated_count", data)
+            results = data["results"]
+
+            response = self.client.get(data["next"])
+            data = response.json()
+            self.assertEqual(len(data["results"]), 1)
+            self.assertIsNone(data["next"])
+            results += data["results"]
+
+        self.assertEqual(
+            [order["date_added"] for order in results],
+            [
+                serializers.DateTimeField().to_representation(
+                    order.date_added
+                )
+                for order in reversed(orders)
+            ],
+        )
+
+    def test_product_search(self):
+        cb = factories.ProductFactory(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+        )
+        factories.ProductFactory(name="Siddhartha", slug="siddhartha")
+
+        response = self.client.get(
+            reverse("product-search-list"), {"q": "cathedral"}
+        )
+        self.assertEqual(response.status_code, 200)
+        results = response.json()["results"]
+        self.assertEqual([r["id"] for r in results], [cb.id])
+        self.assertIn("<mark>cathedral</mark>", results[0]["headline"])
+
+    def test_order_endpoints_answer_conditional_gets(self):
+        product = factories.ProductFactory()
+        order = factories.OrderFactory(status=models.Order.PAID)
+        line = factories.OrderLineFactory(order=order, product=product)
+        self.client.force_login(self.user)
+
+        for url in (
+            reverse("order-list"),
+            reverse("order-detail", args=(order.id,)),
+            reverse("orderline-list"),
+        ):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(
+                url, HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+
+        # Only the rows of the page are looked at, never the whole feed
+        url = reverse("orderline-list")
+        with CaptureQueriesContext(connection) as queries:
+            etag = self.client.get(url)["ETag"]
+        self.assertFalse(
+            [q for q in queries.captured_queries if "COUNT(" in q["sql"]]
+        )
+        factories.OrderLineFactory(order=order, product=product)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        models.OrderLine.objects.filter(pk=line.pk).set_status(
+            models.OrderLine.PROCESSING
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        statuses = {
+            result["id"]: result["status"]
+            for result in response.json()["results"]
+        }
+        self.assertEqual(statuses[line.id], models.OrderLine.PROCESSING)
+
+        response = self.client.get(reverse("order-detail", args=(0,)))
+        self.assertEqual(response.status_code, 404)
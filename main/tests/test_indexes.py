@@ -0,0 +1,114 @@
+import json
+from django.db import connection
+from django.test import TestCase
+from main import models
+from main import factories
+
+
+class TestIndexes(TestCase):
+    """
+    Runs EXPLAIN on the hot queries over a seeded dataset and fails if
+    any of them has to scan a whole table. Sequential scans are
+    disabled for the session, so the planner only falls back to them
+    when no index can serve the query.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        tags = models.ProductTag.objects.bulk_create(
+            models.ProductTag(name="Tag %d" % i, slug="tag-%d" % i)
+            for i in range(50)
+        )
+        products = models.Product.objects.bulk_create(
+            models.Product(
+                name="Book %d" % i,
+                slug="book-%d" % i,
+                price="10.00",
+                active=i % 10 != 0,
+            )
+            for i in range(500)
+        )
+        models.Product.tags.through.objects.bulk_create(
+            models.Product.tags.through(
+                product_id=product.id, producttag_id=tags[i % 50].id
+            )
+            for i, product in enumerate(products)
+        )
+        user = factories.UserFactory()
+        orders = models.Order.objects.bulk_create(
+            models.Order(
+                user=user,
+                status=models.Order.STATUSES[i % 3][0],
+            )
+            for i in range(300)
+        )
+        models.OrderLine.objects.bulk_create(
+            models.OrderLine(
+                order=order,
+                product=products[i],
+                status=models.OrderLine.STATUSES[i % 4][0],
+            )
+            for i, order in enumerate(orders)
+        )
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def seq_scans(self, plan):
+        scans = []
+        if plan.get("Node Type") == "Seq Scan":
+            scans.append(plan["Relation Name"])
+        for child in plan.get("Plans", []):
+            scans += self.seq_scans(child)
+        return scans
+
+    def assertNoSeqScan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self.assertEqual(
+            self.seq_scans(plan[0]["Plan"]), [], str(queryset.query)
+        )
+
+    def test_tag_by_slug(self):
+        self.assertNoSeqScan(
+            models.ProductTag.objects.filter(slug="tag-7")
+        )
+
+    def test_active_products_by_name(self):
+        self.assertNoSeqScan(
+            models.Product.objects.active().order_by("name", "id")[:4]
+        )
+        self.assertNoSeqScan(
+            models.Product.objects.active()
+            .filter(name__gt="Book 2")
+            .order_by("name", "id")[:4]
+        )
+
+    def test_active_products_by_tag(self):
+        self.assertNoSeqScan(
+            models.Product.objects.active()
+            .filter(tags__slug="tag-7")
+            .order_by("name", "id")[:4]
+        )
+
+    def test_paid_orders_by_date(self):
+        self.assertNoSeqScan(
+            models.Order.objects.filter(
+                status=models.Order.PAID
+            ).order_by("-date_added", "-id")[:100]
+        )
+
+    def test_order_lines_by_status(self):
+        order = models.Order.objects.first()
+        self.assertNoSeqScan(
+            models.OrderLine.objects.filter(
+                order=order, status__lt=models.OrderLine.SENT
+            )
+        )
@@ -1,5 +1,9 @@
 from decimal import Decimal
+from unittest.mock import patch
+from django.contrib.auth.models import Group
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from main import models
 from main import factories
 
@@ -38,6 +42,93 @@ class TestModel(TestCase):
             )
             # add more checks here
             self.assertEquals(order.lines.all().count(), 2)
+            self.assertEquals(order.new_lines, 2)
             lines = order.lines.all()
             self.assertEquals(lines[0].product, p1)
             self.assertEquals(lines[1].product, p2)
+
+    def test_create_order_queries_do_not_grow_with_quantity(self):
+        user1 = factories.UserFactory()
+        billing = factories.AddressFactory(user=user1)
+        shipping = factories.AddressFactory(user=user1)
+
+        def checkout(quantity):
+            basket = models.Basket.objects.create(user=user1)
+            for product in factories.ProductFactory.create_batch(2):
+                models.BasketLine.objects.create(
+                    basket=basket, product=product, quantity=quantity
+                )
+            with CaptureQueriesContext(connection) as ctx:
+                order = basket.create_order(billing, shipping)
+            self.assertEquals(order.lines.count(), 2 * quantity)
+            return len(ctx.captured_queries)
+
+        self.assertEquals(checkout(1), checkout(40))
+
+    # The update runs once the checkout commits, which test
+    # transactions never do
+    @patch("django.db.transaction.on_commit", lambda func: func())
+    def test_create_order_updates_recommendations(self):
+        user1 = factories.UserFactory()
+        address = factories.AddressFactory(user=user1)
+        p1, p2, p3 = factories.ProductFactory.create_batch(3)
+
+        def checkout(*products):
+            basket = models.Basket.objects.create(user=user1)
+            for product in products:
+                models.BasketLine.objects.create(
+                    basket=basket, product=product, quantity=2
+                )
+            basket.create_order(address, address)
+
+        checkout(p1, p2, p3)
+        updated = models.Product.objects.get(pk=p1.pk).date_updated
+        checkout(p1, p3)
+        # Product pages show the recommendations
+        self.assertGreater(
+            models.Product.objects.get(pk=p1.pk).date_updated, updated
+        )
+        self.assertEqual(
+            [
+                (r.recommended, r.score)
+                for r in models.Recommendation.objects.for_product(p1)
+            ],
+            [(p3, 2), (p2, 1)],
+        )
+        self.assertEqual(
+            models.CoPurchase.objects.get(product=p2, other=p3).count, 1
+        )
+
+        with patch.object(models.Recommendation, "TOP_K", 1):
+            checkout(p1, p2)
+            checkout(p1, p2)
+        self.assertEqual(
+            [
+                (r.recommended, r.score)
+                for r in models.Recommendation.objects.for_product(p1)
+            ],
+            [(p2, 3)],
+        )
+
+        with patch.object(
+            models.RecommendationManager, "refresh", side_effect=Exception
+        ), self.assertLogs("main.models", level="ERROR"):
+            checkout(p2, p3)
+        self.assertEqual(
+            models.CoPurchase.objects.get(product=p2, other=p3).count, 1
+        )
+
+    def test_user_roles_load_groups_once(self):
+        dispatchers = Group.objects.create(name="Dispatchers")
+        user = models.User.objects.create_user(
+            "dispatcher@booktime.domain", "pw432joij", is_staff=True
+        )
+        user.groups.add(dispatchers)
+        user = models.User.objects.get(id=user.id)
+        with self.assertNumQueries(1):
+            self.assertTrue(user.is_dispatcher)
+            self.assertFalse(user.is_employee)
+            self.assertTrue(user.is_dispatcher)
+
+        user.groups.add(Group.objects.create(name="Employees"))
+        self.assertTrue(user.is_employee)
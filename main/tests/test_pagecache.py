@@ -0,0 +1,160 @@
+from decimal import Decimal
+from unittest.mock import patch
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from main import admin, catalog, models
+from main.pagecache import cache_anonymous_page, page_key
+
+
+@override_settings(SHARED_CACHE=True)
+@patch("webpack_loader.utils.get_as_tags", return_value=[])
+class TestPageCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tag = models.ProductTag.objects.create(
+            name="Open source", slug="opensource"
+        )
+        self.cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.cb.tags.add(self.tag)
+        self.other = models.Product.objects.create(
+            name="A tale of two cities",
+            slug="tale-two-cities",
+            price=Decimal("2.00"),
+        )
+        self.detail_url = reverse(
+            "product", kwargs={"slug": "cathedral-bazaar"}
+        )
+        self.list_url = reverse("products", kwargs={"tag": "opensource"})
+
+    def assertCached(self, url):
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertNotCached(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertTrue(queries, "%s was served from the cache" % url)
+
+    def test_anonymous_pages_are_cached(self, get_as_tags):
+        for url in (
+            reverse("home"),
+            reverse("about_us"),
+            self.detail_url,
+            self.list_url,
+        ):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            cached = self.assertCached(url)
+            self.assertEqual(cached.content, response.content)
+
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                self.list_url, HTTP_IF_NONE_MATCH=cached["ETag"]
+            )
+        self.assertEqual(response.status_code, 304)
+
+    def test_users_and_baskets_bypass_the_cache(self, get_as_tags):
+        self.client.get(self.detail_url)
+        self.client.get(reverse("add_to_basket"), {"product_id": self.cb.id})
+        response = self.client.get(self.detail_url)
+        self.assertContains(response, "items in basket")
+
+        self.client.cookies.clear()
+        user = models.User.objects.create_user("user1@a.com", "pw432joij")
+        self.client.force_login(user)
+        self.assertNotCached(self.detail_url)
+
+    def test_pages_setting_cookies_are_not_cached(self, get_as_tags):
+        def plain(request):
+            return HttpResponse("plain")
+
+        def form(request):
+            return HttpResponse(get_token(request))
+
+        def session(request):
+            request.session["seen"] = True
+            return HttpResponse("seen")
+
+        for view, cached in ((plain, True), (form, False), (session, False)):
+            request = RequestFactory().get("/%s/" % view.__name__)
+            request.user = AnonymousUser()
+            request.basket = None
+            request.session = SessionStore()
+            cache_anonymous_page(view)(request)
+            self.assertEqual(
+                cache.get(page_key(request)) is not None, cached, view
+            )
+
+    def test_saves_purge_the_affected_pages(self, get_as_tags):
+        other_url = reverse("product", kwargs={"slug": "tale-two-cities"})
+        all_url = reverse("products", kwargs={"tag": "all"})
+        for url in (self.detail_url, self.list_url, other_url, all_url):
+            self.client.get(url)
+
+        self.cb.name = "The cathedral & the bazaar"
+        self.cb.save()
+        response = self.client.get(self.detail_url)
+        self.assertContains(response, "The cathedral &amp; the bazaar")
+        self.assertNotCached(self.list_url)
+        self.assertNotCached(all_url)
+        self.assertCached(other_url)
+
+        self.tag.name = "Free software"
+        self.tag.save()
+        self.assertContains(self.client.get(self.detail_url), "Free software")
+        self.assertCached(other_url)
+
+        self.other.tags.add(self.tag)
+        self.assertNotCached(other_url)
+        self.assertNotCached(self.list_url)
+
+    def test_admin_actions_purge_the_listings(self, get_as_tags):
+        all_url = reverse("products", kwargs={"tag": "all"})
+        self.client.get(all_url)
+        self.client.get(self.list_url)
+
+        admin.make_inactive(
+            None, None, models.Product.objects.filter(pk=self.cb.pk)
+        )
+        response = self.client.get(self.list_url)
+        self.assertEqual(list(response.context["object_list"]), [])
+        response = self.client.get(all_url)
+        self.assertEqual(
+            list(response.context["object_list"]), [self.other]
+        )
+
+    def test_purges_are_repeated_on_commit(self, get_as_tags):
+        entries = catalog.get_entries("all")
+        committed = []
+        with patch("django.db.transaction.on_commit", committed.append):
+            self.cb.name = "The cathedral & the bazaar"
+            self.cb.save()
+        self.assertNotEqual(catalog.get_entries("all"), entries)
+        # A list cached before the commit may hold older rows
+        updated, _ = catalog.get_listing("all")
+        self.assertEqual(catalog.get_listing("all")[0], updated)
+        for func in committed:
+            func()
+        self.assertNotEqual(catalog.get_listing("all")[0], updated)
+
+    @override_settings(SHARED_CACHE=False)
+    def test_nothing_is_cached_without_a_shared_cache(self, get_as_tags):
+        self.client.get(self.list_url)
+        self.assertNotCached(self.list_url)
+        self.assertNotCached(self.detail_url)
+        self.cb.tags.remove(self.tag)
+        response = self.client.get(self.list_url)
+        self.assertEqual(list(response.context["object_list"]), [])
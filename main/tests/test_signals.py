@@ -1,10 +1,18 @@
-from django.test import TestCase
-from main import models
+import os
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+from PIL import Image
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from main import models, factories, thumbnails
+from django.core.files.base import ContentFile
 from django.core.files.images import ImageFile
 from decimal import Decimal
 
 
 class TestSignal(TestCase):
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
     def test_thumbnails_are_generated_on_save(self):
         product = models.Product(
             name="The cathedral and the bazaar",
@@ -22,8 +30,22 @@ class TestSignal(TestCase):
             with self.assertLogs("main", level="INFO") as cm:
                 image.save()
         self.assertGreaterEqual(len(cm.output), 1)
+        self.assertFalse(image.thumbnail)
+        self.assertTrue(
+            models.ThumbnailJob.objects.filter(image=image).exists()
+        )
+
+        self.assertEqual(thumbnails.process_jobs(), 1)
+        self.assertFalse(models.ThumbnailJob.objects.exists())
         image.refresh_from_db()
 
+        self.assertEqual(image.renditions.count(), 6)
+
+        # Saves without a new source image keep the thumbnail
+        image.save()
+        self.assertTrue(image.thumbnail)
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+
         with open(
                 "main/fixtures/the-cathedral-the-bazaar.thumb.jpg",
                 "rb",
@@ -32,3 +54,193 @@ class TestSignal(TestCase):
             assert image.thumbnail.read() == expected_content
         image.thumbnail.delete(save=False)
         image.image.delete(save=False)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_identical_images_share_files_and_renditions(self):
+        products = factories.ProductFactory.create_batch(2)
+        images = []
+        for product in products:
+            with open(
+                "main/fixtures/the-cathedral-the-bazaar.jpg", "rb"
+            ) as f:
+                images.append(
+                    models.ProductImage.objects.create(
+                        product=product, image=ImageFile(f, name="tctb.jpg")
+                    )
+                )
+        self.assertEqual(images[0].image.name, images[1].image.name)
+        thumbnails.process_jobs()
+        self.assertEqual(models.ThumbnailJob.objects.count(), 0)
+
+        os.utime(images[0].image.path, (0, 0))
+        with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+            image = models.ProductImage.objects.create(
+                product=products[0], image=ImageFile(f, name="copy.jpg")
+            )
+        self.assertFalse(models.ThumbnailJob.objects.exists())
+        # Saving the same file again counts as a use for gc_media
+        self.assertGreater(os.path.getmtime(image.image.path), 0)
+        image.refresh_from_db()
+        images[0].refresh_from_db()
+        self.assertEqual(image.thumbnail.name, images[0].thumbnail.name)
+        self.assertEqual(
+            sorted(image.renditions.values_list("file", flat=True)),
+            sorted(images[0].renditions.values_list("file", flat=True)),
+        )
+
+    def test_worker_pool_keeps_connections_in_transactions(self):
+        self.assertIsNone(thumbnails.worker_pool(1))
+        pool = thumbnails.worker_pool(2)
+        try:
+            self.assertEqual(list(pool.map(abs, [-1, -2])), [1, 2])
+        finally:
+            pool.shutdown()
+        # The test transaction is still there
+        self.assertEqual(models.Product.objects.count(), 0)
+
+    def test_renditions_are_made_from_a_draft_decode(self):
+        with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+            data = f.read()
+        thumbnail, renditions = thumbnails.make_renditions(data)
+        self.assertEqual(Image.open(BytesIO(thumbnail)).size, (194, 300))
+        # No rendition is wider than the 353px source
+        self.assertEqual(
+            [(width, format) for width, format, _ in renditions],
+            [
+                (353, "webp"), (353, "jpeg"),
+                (300, "webp"), (300, "jpeg"),
+                (150, "webp"), (150, "jpeg"),
+            ],
+        )
+        for width, format, content in renditions:
+            image = Image.open(BytesIO(content))
+            self.assertEqual(image.format.lower(), format)
+            self.assertEqual(image.width, width)
+
+        large = Image.new("RGB", (4000, 3000), "white")
+        output = BytesIO()
+        large.save(output, "JPEG")
+        with patch.object(
+            Image.Image, "convert", autospec=True,
+            side_effect=Image.Image.convert,
+        ) as convert:
+            thumbnail, renditions = thumbnails.make_renditions(
+                output.getvalue()
+            )
+        # libjpeg scaled by 2 while decoding, down to the 1200px needed
+        self.assertEqual(convert.call_args[0][0].size, (2000, 1500))
+        self.assertEqual(renditions[0][0], 1200)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    def test_failed_thumbnails_are_retried_then_left(self):
+        product = factories.ProductFactory()
+        image = models.ProductImage(product=product)
+        image.image.save(
+            "broken.jpg", ContentFile(b"not an image"), save=False
+        )
+        image.save()
+
+        with self.assertLogs("main.thumbnails", level="WARNING"):
+            for attempt in range(models.ThumbnailJob.MAX_ATTEMPTS):
+                self.assertEqual(thumbnails.process_jobs(), 1)
+        self.assertEqual(thumbnails.process_jobs(), 0)
+        image.refresh_from_db()
+        self.assertFalse(image.thumbnail)
+
+    def test_order_marked_done_when_all_lines_processed(self):
+        product = factories.ProductFactory()
+        order = factories.OrderFactory()
+        lines = factories.OrderLineFactory.create_batch(
+            2, order=order, product=product
+        )
+        order.refresh_from_db()
+        self.assertEqual(order.new_lines, 2)
+
+        lines[0].status = models.OrderLine.PROCESSING
+        # The locked status read, the row update and the counters
+        with self.assertNumQueries(3):
+            lines[0].save()
+        order.refresh_from_db()
+        self.assertEqual(order.new_lines, 1)
+        self.assertEqual(order.processing_lines, 1)
+
+        lines[0].status = models.OrderLine.SENT
+        lines[0].save()
+        order.refresh_from_db()
+        self.assertEqual(order.processing_lines, 0)
+        self.assertEqual(order.sent_lines, 1)
+        self.assertEqual(order.status, models.Order.NEW)
+
+        lines[1].status = models.OrderLine.CANCELLED
+        with self.assertLogs("main", level="INFO"):
+            lines[1].save()
+        order.refresh_from_db()
+        self.assertEqual(order.new_lines, 0)
+        self.assertEqual(order.cancelled_lines, 1)
+        self.assertEqual(order.status, models.Order.DONE)
+
+        lines[1].delete()
+        order.refresh_from_db()
+        self.assertEqual(order.cancelled_lines, 0)
+
+    def test_stale_line_status_changes_keep_counters(self):
+        order = factories.OrderFactory()
+        line = factories.OrderLineFactory(
+            order=order, product=factories.ProductFactory()
+        )
+        first = models.OrderLine.objects.get(pk=line.pk)
+        second = models.OrderLine.objects.get(pk=line.pk)
+        # Both copies were loaded as new; only one moves it out of new
+        for copy in (first, second):
+            copy.status = models.OrderLine.PROCESSING
+            copy.save()
+        order.refresh_from_db()
+        self.assertEqual(order.new_lines, 0)
+        self.assertEqual(order.processing_lines, 1)
+
+        second.status = models.OrderLine.SENT
+        second.save()
+        first.delete()
+        order.refresh_from_db()
+        self.assertEqual(order.processing_lines, 0)
+        self.assertEqual(order.sent_lines, 0)
+
+    def test_stale_order_saves_keep_counters_and_status(self):
+        order = factories.OrderFactory()
+        line = factories.OrderLineFactory(
+            order=order, product=factories.ProductFactory()
+        )
+        stale = models.Order.objects.get(pk=order.pk)
+        line.status = models.OrderLine.SENT
+        line.save()
+        stale.billing_name = "Someone else"
+        stale.save()
+        order.refresh_from_db()
+        self.assertEqual(order.billing_name, "Someone else")
+        self.assertEqual(order.new_lines, 0)
+        self.assertEqual(order.sent_lines, 1)
+        self.assertEqual(order.status, models.Order.DONE)
+
+        # A status set on the instance is still written
+        order.status = models.Order.PAID
+        order.save()
+        order.refresh_from_db()
+        self.assertEqual(order.status, models.Order.PAID)
+        self.assertEqual(order.sent_lines, 1)
+
+
+class TestOrderLineSignals(TransactionTestCase):
+    def test_failed_line_save_leaves_status_and_counters(self):
+        order = factories.OrderFactory()
+        line = factories.OrderLineFactory(
+            order=order, product=factories.ProductFactory()
+        )
+        line.status = models.OrderLine.PROCESSING
+        line.product_id = 0
+        with self.assertRaises(IntegrityError):
+            line.save()
+        line.refresh_from_db()
+        self.assertEqual(line.status, models.OrderLine.NEW)
+        order.refresh_from_db()
+        self.assertEqual(order.new_lines, 1)
+        self.assertEqual(order.processing_lines, 0)
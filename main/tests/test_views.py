@@ -1,14 +1,33 @@
+from datetime import timedelta
 from decimal import Decimal
+from io import BytesIO
+import os
+import tempfile
+import time
 
-from django.test import TestCase
+from PIL import Image
+
+from django.core.files.images import ImageFile
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from main import models, forms
+from main import models, forms, renditions, thumbnails
+from main.middlewares import (
+    BASKET_SUMMARY_TIMEOUT, basket_middleware, get_basket
+)
 from unittest.mock import patch
 from django.contrib import auth
 
 
 # Create your tests here.
 class TestPage(TestCase):
+    def setUp(self):
+        # The catalog lists outlive the rolled back test transactions
+        cache.clear()
+
     def test_home_page_works(self):
         response = self.client.get(reverse("home"))
         self.assertEqual(response.status_code, 200)
@@ -213,7 +232,7 @@ class TestPage(TestCase):
             slug="microsoft-guindows-guide",
             price=Decimal("12.00"),
         )
-        basket = models.Basket.objects.create(user=user1)
+        basket = models.Basket.objects.create(user=user1, item_count=2)
         models.BasketLine.objects.create(
             basket=basket, product=cb, quantity=2
         )
@@ -234,3 +253,612 @@ class TestPage(TestCase):
 
         basket = models.Basket.objects.get(user=user1)
         self.assertEquals(basket.count(), 3)
+
+    def test_stale_basket_id_is_dropped_from_session(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.client.force_login(
+            models.User.objects.create_user("user1@a.com", "pw432joij")
+        )
+        self.client.get(
+            reverse("add_to_basket"), {"product_id": cb.id}
+        )
+        basket_id = self.client.session["basket_id"]
+        models.Basket.objects.filter(id=basket_id).delete()
+
+        response = self.client.get(reverse("basket"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context["formset"])
+        self.assertNotIn("basket_id", self.client.session)
+
+    def test_basket_badge_is_read_from_the_session(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.client.force_login(
+            models.User.objects.create_user("user1@a.com", "pw432joij")
+        )
+        for i in range(2):
+            self.client.get(
+                reverse("add_to_basket"), {"product_id": cb.id}
+            )
+        basket_table = models.Basket._meta.db_table
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("about_us"))
+        self.assertContains(response, "2\n        items in basket")
+        self.assertFalse(
+            [q for q in queries if basket_table in q["sql"]]
+        )
+
+        # Changes made outside the session show once the copy expires
+        models.Basket.objects.filter(
+            id=self.client.session["basket_id"]
+        ).update(item_count=5)
+        self.assertContains(
+            self.client.get(reverse("about_us")), "2\n        items in basket"
+        )
+        with patch(
+            "main.middlewares.time.time",
+            return_value=time.time() + BASKET_SUMMARY_TIMEOUT,
+        ):
+            response = self.client.get(reverse("about_us"))
+        self.assertContains(response, "5\n        items in basket")
+
+    def test_basket_is_resolved_lazily_once_per_request(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.client.force_login(
+            models.User.objects.create_user("user1@a.com", "pw432joij")
+        )
+        self.client.get(
+            reverse("add_to_basket"), {"product_id": cb.id}
+        )
+        request = RequestFactory().get("/")
+        request.session = self.client.session
+        basket_id = request.session["basket_id"]
+
+        with self.assertNumQueries(0):
+            basket_middleware(lambda request: None)(request)
+        with self.assertNumQueries(1):
+            self.assertEqual(request.basket.id, basket_id)
+        with self.assertNumQueries(0):
+            self.assertEqual(request.basket.count(), 1)
+        # Changes made elsewhere show on the next request
+        models.Basket.objects.filter(id=basket_id).update(
+            status=models.Basket.SUBMITTED
+        )
+        self.assertEqual(
+            get_basket(request).status, models.Basket.SUBMITTED
+        )
+
+    def test_basket_item_count_follows_basket_changes(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.client.force_login(
+            models.User.objects.create_user("user1@a.com", "pw432joij")
+        )
+        for i in range(3):
+            self.client.get(
+                reverse("add_to_basket"), {"product_id": cb.id}
+            )
+        basket = models.Basket.objects.get(
+            id=self.client.session["basket_id"]
+        )
+        self.assertEqual(basket.item_count, 3)
+        line = basket.basketline_set.get()
+
+        response = self.client.post(
+            reverse("basket"),
+            {
+                "basketline_set-TOTAL_FORMS": 1,
+                "basketline_set-INITIAL_FORMS": 1,
+                "basketline_set-MIN_NUM_FORMS": 0,
+                "basketline_set-MAX_NUM_FORMS": 1000,
+                "basketline_set-0-id": line.id,
+                "basketline_set-0-quantity": 5,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "5\n        items in basket")
+        basket.refresh_from_db()
+        self.assertEqual(basket.item_count, 5)
+
+        # Deleting a product deletes its lines
+        other = models.Product.objects.create(
+            name="A tale of two cities", slug="tale-two-cities",
+            price=Decimal("2.00"),
+        )
+        basket.add_product(other, 2)
+        cb.delete()
+        basket.refresh_from_db()
+        self.assertEqual(basket.item_count, 2)
+        self.assertFalse(basket.is_empty())
+        other.delete()
+        basket.refresh_from_db()
+        self.assertTrue(basket.is_empty())
+
+    def test_add_to_basket_json_works(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        self.client.force_login(
+            models.User.objects.create_user("user1@a.com", "pw432joij")
+        )
+        response = self.client.post(
+            reverse("add_to_basket_json"), {"product": cb.id}
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            reverse("add_to_basket_json"),
+            {"product": cb.id, "quantity": 2},
+        )
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["line"]["quantity"], 3)
+        self.assertEqual(data["basket"]["count"], 3)
+        self.assertEqual(
+            models.BasketLine.objects.get(id=data["line"]["id"]).quantity,
+            3,
+        )
+
+        response = self.client.post(
+            reverse("add_to_basket_json"), {"product": cb.id + 1}
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("product", response.json()["errors"])
+
+    def test_anonymous_basket_stays_in_session_until_login(self):
+        user1 = models.User.objects.create_user(
+            "user1@a.com", "pw432joij"
+        )
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        w = models.Product.objects.create(
+            name="Microsoft Guindows guide",
+            slug="microsoft-guindows-guide",
+            price=Decimal("12.00"),
+        )
+        for product in [cb, cb, w]:
+            self.client.get(
+                reverse("add_to_basket"), {"product_id": product.id}
+            )
+        self.assertFalse(models.Basket.objects.exists())
+
+        response = self.client.get(reverse("basket"))
+        self.assertContains(response, "3\n        items in basket")
+        formset = response.context["formset"]
+        self.assertEqual(
+            [form.instance.product for form in formset], [cb, w]
+        )
+        response = self.client.post(
+            reverse("basket"),
+            {
+                "form-TOTAL_FORMS": 2,
+                "form-INITIAL_FORMS": 2,
+                "form-MIN_NUM_FORMS": 0,
+                "form-MAX_NUM_FORMS": 1000,
+                "form-0-product": cb.id,
+                "form-0-quantity": 4,
+                "form-1-product": w.id,
+                "form-1-quantity": 1,
+                "form-1-DELETE": "on",
+            },
+        )
+        self.assertContains(response, "4\n        items in basket")
+        self.assertFalse(models.Basket.objects.exists())
+
+        self.client.post(
+            reverse("login"),
+            {"email": "user1@a.com", "password": "pw432joij"},
+        )
+        basket = models.Basket.objects.get(user=user1)
+        self.assertEqual(basket.count(), 4)
+        self.assertEqual(
+            list(basket.basketline_set.values_list("product", "quantity")),
+            [(cb.id, 4)],
+        )
+        self.assertEqual(self.client.session["basket_id"], basket.id)
+
+    def test_login_merge_folds_anonymous_basket_lines(self):
+        user1 = models.User.objects.create_user(
+            "user1@a.com", "pw432joij"
+        )
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        w = models.Product.objects.create(
+            name="Microsoft Guindows guide",
+            slug="microsoft-guindows-guide",
+            price=Decimal("12.00"),
+        )
+        basket = models.Basket.objects.create(user=user1, item_count=2)
+        models.BasketLine.objects.create(
+            basket=basket, product=cb, quantity=2
+        )
+        anonymous_basket = models.Basket.objects.create(item_count=3)
+        models.BasketLine.objects.create(
+            basket=anonymous_basket, product=cb, quantity=1
+        )
+        models.BasketLine.objects.create(
+            basket=anonymous_basket, product=w, quantity=2
+        )
+        session = self.client.session
+        session["basket_id"] = anonymous_basket.id
+        session.save()
+
+        self.client.post(
+            reverse("login"),
+            {"email": "user1@a.com", "password": "pw432joij"},
+        )
+        self.assertFalse(
+            models.Basket.objects.filter(id=anonymous_basket.id).exists()
+        )
+        basket.refresh_from_db()
+        self.assertEqual(basket.count(), 5)
+        self.assertEqual(
+            dict(basket.basketline_set.values_list("product", "quantity")),
+            {cb.id: 3, w.id: 2},
+        )
+        self.assertEqual(self.client.session["basket_id"], basket.id)
+
+    def test_products_page_keyset_pagination(self):
+        for i in range(10):
+            models.Product.objects.create(
+                name="Book %d" % (i // 2),
+                slug="book-%d" % i,
+                price=Decimal("10.00"),
+            )
+        product_list = list(
+            models.Product.objects.active().order_by("name", "id")
+        )
+        url = reverse("products", kwargs={"tag": "all"})
+
+        response = self.client.get(url)
+        self.assertEqual(
+            list(response.context["object_list"]), product_list[:4]
+        )
+        self.assertFalse(response.context["page_obj"].has_previous())
+        self.assertContains(response, "About 10 products")
+        next_cursor = response.context["page_obj"].next_cursor
+
+        response = self.client.get(url, {"cursor": next_cursor})
+        self.assertEqual(
+            list(response.context["object_list"]), product_list[4:8]
+        )
+        # The estimate is only worked out for the first page
+        self.assertNotContains(response, "About 10 products")
+        page = response.context["page_obj"]
+        next_cursor = page.next_cursor
+        previous_cursor = page.previous_cursor
+
+        response = self.client.get(url, {"cursor": next_cursor})
+        self.assertEqual(
+            list(response.context["object_list"]), product_list[8:]
+        )
+        self.assertFalse(response.context["page_obj"].has_next())
+
+        response = self.client.get(url, {"cursor": previous_cursor})
+        self.assertEqual(
+            list(response.context["object_list"]), product_list[:4]
+        )
+        self.assertFalse(response.context["page_obj"].has_previous())
+
+        response = self.client.get(url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+
+    # Query counts of the views themselves, without the page cache
+    @override_settings(SHARED_CACHE=True)
+    @patch("main.pagecache.is_cacheable", return_value=False)
+    def test_products_page_reads_catalog_cache(self, is_cacheable):
+        tag = models.ProductTag.objects.create(
+            name="Open source", slug="opensource"
+        )
+        for i in range(6):
+            product = models.Product.objects.create(
+                name="Book %d" % i,
+                slug="book-%d" % i,
+                price=Decimal("10.00"),
+            )
+            product.tags.add(tag)
+        url = reverse("products", kwargs={"tag": "opensource"})
+        all_url = reverse("products", kwargs={"tag": "all"})
+        self.client.get(url)
+        self.client.get(all_url)
+
+        # Without a session: only the page rows. The validators come
+        # from the cached list.
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        etag = response["ETag"]
+        self.assertEqual(
+            [p.name for p in response.context["object_list"]],
+            ["Book 0", "Book 1", "Book 2", "Book 3"],
+        )
+        self.assertEqual(response.context["paginator"].estimated_count(), 6)
+
+        # Lists follow saves, M2M changes and deletes
+        first = models.Product.objects.get(slug="book-0")
+        first.name = "Book 9"
+        first.save()
+        models.Product.objects.get(slug="book-1").tags.remove(tag)
+        models.Product.objects.get(slug="book-2").delete()
+        inactive = models.Product.objects.get(slug="book-3")
+        inactive.active = False
+        inactive.save()
+        new = models.Product.objects.create(
+            name="Book 10", slug="book-10", price=Decimal("10.00")
+        )
+        tag.product_set.add(new)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [p.name for p in response.context["object_list"]],
+            ["Book 10", "Book 4", "Book 5", "Book 9"],
+        )
+        response = self.client.get(all_url)
+        self.assertEqual(response.context["paginator"].estimated_count(), 5)
+
+        tag.slug = "free-software"
+        tag.save()
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            reverse("products", kwargs={"tag": "free-software"})
+        )
+        self.assertEqual(len(response.context["object_list"]), 4)
+
+    @override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    # The imageswitcher bundle is only there after a webpack build
+    @patch("webpack_loader.utils.get_as_tags", return_value=[])
+    # Query counts of the views themselves, without the page cache
+    @patch("main.pagecache.is_cacheable", return_value=False)
+    def test_product_page_has_fixed_query_count(self, is_cacheable,
+                                                get_as_tags):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        cb.tags.create(name="Open source", slug="opensource")
+        cb.tags.create(name="Essays", slug="essays")
+        models.Product.objects.create(
+            name="Cathedral and bazaar (old)",
+            slug="cathedral-bazaar",
+            price=Decimal("8.00"),
+            active=False,
+        )
+        for name in ("front.jpg", "back.jpg"):
+            with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+                models.ProductImage.objects.create(
+                    product=cb, image=ImageFile(f, name=name)
+                )
+        url = reverse("product", kwargs={"slug": "cathedral-bazaar"})
+
+        with self.assertNumQueries(6):
+            response = self.client.get(url)
+        self.assertEqual(response.context["object"], cb)
+        self.assertContains(response, "Open source")
+        self.assertEqual(len(response.context["images"]), 2)
+        self.assertContains(response, 'id="product-images"')
+
+        # The image list is cached until the product changes
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+        self.assertEqual(len(response.context["images"]), 2)
+        cb.productimage_set.first().delete()
+        response = self.client.get(url)
+        self.assertEqual(len(response.context["images"]), 1)
+
+        response = self.client.get(
+            reverse("product", kwargs={"slug": "missing"})
+        )
+        self.assertEqual(response.status_code, 404)
+
+    # Query counts of the views themselves, without the page cache
+    @override_settings(SHARED_CACHE=True)
+    @patch("main.pagecache.is_cacheable", return_value=False)
+    def test_product_pages_answer_conditional_gets(self, is_cacheable):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            price=Decimal("10.00"),
+        )
+        # Listings are validated from the catalog cache alone
+        for url, queries in (
+            (reverse("product", kwargs={"slug": "cathedral-bazaar"}), 1),
+            (reverse("products", kwargs={"tag": "all"}), 0),
+        ):
+            with patch("webpack_loader.utils.get_as_tags", return_value=[]):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response["ETag"]
+            last_modified = response["Last-Modified"]
+
+            with self.assertNumQueries(queries):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.content, b"")
+            response = self.client.get(
+                url, HTTP_IF_MODIFIED_SINCE=last_modified
+            )
+            self.assertEqual(response.status_code, 304)
+
+            # Adding to the basket changes what the page shows
+            self.client.get(
+                reverse("add_to_basket"), {"product_id": cb.id}
+            )
+            with patch("webpack_loader.utils.get_as_tags", return_value=[]):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.client.cookies.clear()
+
+        models.Product.objects.filter(pk=cb.pk).update(
+            date_updated=cb.date_updated - timedelta(days=1)
+        )
+        url = reverse("products", kwargs={"tag": "all"})
+        etag = self.client.get(url)["ETag"]
+        cb.active = False
+        cb.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        MEDIA_ROOT=tempfile.mkdtemp(),
+        RENDITION_CACHE_ROOT=tempfile.mkdtemp(),
+        RENDITION_CACHE_MAX_SIZE=100000,
+    )
+    def test_image_renditions_are_made_on_demand(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            price=Decimal("10.00"),
+        )
+        with open("main/fixtures/the-cathedral-the-bazaar.jpg", "rb") as f:
+            image = models.ProductImage.objects.create(
+                product=cb, image=ImageFile(f, name="cb.jpg")
+            )
+        self.assertEqual(image.renditions.count(), 0)
+        srcsets = thumbnails.srcsets(image)
+        url = renditions.url(image.image.name, 300, "webp")
+        self.assertIn("%s 300w" % url, srcsets["webp"])
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertIn("max-age=31536000", response["Cache-Control"])
+        data = b"".join(response.streaming_content)
+        rendition = Image.open(BytesIO(data))
+        self.assertEqual(rendition.format, "WEBP")
+        self.assertEqual(rendition.width, 300)
+
+        # Served from the disk cache, without reading the source again
+        with patch("main.thumbnails.make_rendition") as make_rendition:
+            response = self.client.get(url)
+            self.assertEqual(b"".join(response.streaming_content), data)
+        make_rendition.assert_not_called()
+
+        # Never larger than the source
+        response = self.client.get(
+            renditions.url(image.image.name, 2400, "jpeg")
+        )
+        width = Image.open(BytesIO(b"".join(response.streaming_content))).width
+        self.assertEqual(width, Image.open(image.image.path).width)
+
+        for width, format in ((310, "webp"), (5000, "jpeg"), (0, "jpeg")):
+            response = self.client.get(
+                renditions.url(image.image.name, width, format)
+            )
+            self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            renditions.url("0" * 64 + ".jpg", 300, "webp")
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_rendition_cache_evicts_least_recently_used(self):
+        root = tempfile.mkdtemp()
+        disk_cache = renditions.DiskCache(root, 250)
+
+        def cached(key):
+            f = disk_cache.get(key)
+            if f is None:
+                return False
+            f.close()
+            return True
+
+        with patch.object(
+            disk_cache, "entries", wraps=disk_cache.entries
+        ) as entries:
+            for i, key in enumerate(("aa-1", "bb-1", "cc-1")):
+                disk_cache.put(key, b"x" * 100).close()
+                # Distinct times, older first
+                os.utime(disk_cache.path(key), (i, i))
+        # Once to learn the size, then when it goes over the limit
+        self.assertEqual(entries.call_count, 2)
+        self.assertFalse(cached("aa-1"))
+        self.assertTrue(cached("bb-1"))
+        disk_cache.put("dd-1", b"x" * 100).close()
+        self.assertFalse(cached("cc-1"))
+        self.assertTrue(cached("bb-1"))
+        self.assertTrue(cached("dd-1"))
+
+        # A file being read survives its eviction
+        f = disk_cache.get("bb-1")
+        os.utime(disk_cache.path("bb-1"), (0, 0))
+        disk_cache.put("ee-1", b"x" * 100).close()
+        self.assertFalse(cached("bb-1"))
+        self.assertEqual(f.read(), b"x" * 100)
+        f.close()
+
+    def test_product_search_ranks_and_highlights(self):
+        cb = models.Product.objects.create(
+            name="The cathedral and the bazaar",
+            slug="cathedral-bazaar",
+            description="Open source <b>classic</b>",
+            price=Decimal("10.00"),
+        )
+        guide = models.Product.objects.create(
+            name="A guide to markets",
+            slug="guide-markets",
+            description="Every bazaar in town",
+            price=Decimal("12.00"),
+        )
+        tag = models.ProductTag.objects.create(
+            name="Programming", slug="programming"
+        )
+        guide.tags.add(tag)
+        models.Product.objects.create(
+            name="Siddhartha",
+            slug="siddhartha",
+            price=Decimal("6.00"),
+        )
+
+        response = self.client.get(
+            reverse("product_search"), {"q": "bazaars"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            list(response.context["object_list"]), [cb, guide]
+        )
+        self.assertContains(response, "<mark>bazaar</mark>")
+        self.assertNotContains(response, "<b>classic")
+
+        response = self.client.get(
+            reverse("product_search"), {"q": "programming"}
+        )
+        self.assertEqual(list(response.context["object_list"]), [guide])
+
+        # Other tag fields are not searched: products are left alone
+        updated = models.Product.objects.get(pk=guide.pk).date_updated
+        tag.description = "Books about programming"
+        tag.save()
+        self.assertEqual(
+            models.Product.objects.get(pk=guide.pk).date_updated, updated
+        )
+
+        tag.name = "Travel"
+        tag.save()
+        response = self.client.get(
+            reverse("product_search"), {"q": "travel"}
+        )
+        self.assertEqual(list(response.context["object_list"]), [guide])
+
+        tag.delete()
+        self.assertEqual(list(models.Product.objects.search("travel")), [])
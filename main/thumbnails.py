@@ -0,0 +1,369 @@
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from . import pagecache, renditions as on_demand
+from .models import (
+    Product,
+    ProductImage,
+    ProductImageRendition,
+    ThumbnailJob,
+)
+from .storage import media_storage
+
+THUMBNAIL_SIZE = (300, 300)
+
+# Shown by the product page until the worker has made the thumbnail
+PLACEHOLDER = "images/thumbnail-placeholder.svg"
+
+logger = logging.getLogger(__name__)
+
+
+FORMATS = {
+    ProductImageRendition.WEBP: ("WEBP", {"quality": 80, "method": 4}),
+    ProductImageRendition.JPEG: (
+        "JPEG", {"quality": 85, "optimize": True, "progressive": True}
+    ),
+}
+
+
+def encode(image, format):
+    name, options = FORMATS[format]
+    output = BytesIO()
+    image.save(output, name, **options)
+    return output.getvalue()
+
+
+def decode(image, width):
+    """
+    Decode an opened image to RGB, at no less than width pixels wide
+    but, for JPEGs, possibly much less than its full size.
+    """
+    height = max(round(image.height * width / image.width), 1)
+    image.draft("RGB", (width, height))
+    return image.convert("RGB")
+
+
+def resize(image, width, height):
+    if image.size == (width, height):
+        return image
+    return image.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+
+
+def make_rendition(data, width, format):
+    """A single rendition of the image in data, at most width wide."""
+    image = Image.open(BytesIO(data))
+    original_width, original_height = image.size
+    width = min(width, original_width)
+    height = max(round(original_height * width / original_width), 1)
+    return encode(resize(decode(image, width), width, height), format)
+
+
+def make_renditions(data):
+    """
+    The JPEG thumbnail and the (width, format, bytes) renditions of
+    the image in data, from a single decode. Runs in worker processes.
+
+    JPEGs are decoded with draft(), which lets libjpeg scale down by up
+    to 8x while decoding, to the smallest size that still covers the
+    largest output. Other formats are shrunk with reduce() before the
+    resampling filter runs, through reducing_gap.
+    """
+    image = Image.open(BytesIO(data))
+    width, height = image.size
+    widths = sorted(
+        {min(w, width) for w in ProductImageRendition.WIDTHS}, reverse=True
+    )
+    scale = max(
+        widths[0] / width,
+        min(THUMBNAIL_SIZE[0] / width, THUMBNAIL_SIZE[1] / height, 1),
+    )
+    image = decode(image, round(width * scale))
+
+    thumbnail = image.copy()
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Image.ANTIALIAS)
+    output = BytesIO()
+    thumbnail.save(output, "JPEG")
+
+    renditions = []
+    current = image
+    for w in widths:
+        # Each size is resampled from the previous, larger one
+        current = resize(current, w, max(round(height * w / width), 1))
+        for format in FORMATS:
+            renditions.append((w, format, encode(current, format)))
+    return output.getvalue(), renditions
+
+
+def try_make_renditions(data):
+    try:
+        return make_renditions(data), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+def worker_pool(workers, **kwargs):
+    """
+    A pool of worker processes for the resizing, or None when workers
+    is 1 and it happens in this process. kwargs go to the pool.
+
+    The workers never use the database and must not share the
+    connections of this process, which are closed before they fork.
+    Within a transaction, which closing would break, they are kept:
+    the workers inherit them but leave them untouched.
+    """
+    if workers <= 1:
+        return None
+    if not any(conn.in_atomic_block for conn in connections.all()):
+        connections.close_all()
+    return ProcessPoolExecutor(workers, **kwargs)
+
+
+def read_source(image):
+    try:
+        with image.image.open("rb") as f:
+            return f.read()
+    except (OSError, ValueError):
+        logger.exception("Cannot read image %d", image.id)
+        return b""
+
+
+def process_jobs(batch_size=10, pool=None):
+    """
+    Make the thumbnails and renditions of up to batch_size queued
+    images, with the map() of pool if given. Jobs are claimed with SKIP
+    LOCKED, so any number of workers can share the queue. Returns the
+    number of jobs claimed.
+    """
+    with transaction.atomic():
+        jobs = list(
+            ThumbnailJob.objects.select_for_update(
+                skip_locked=True, of=("self",)
+            )
+            .filter(attempts__lt=ThumbnailJob.MAX_ATTEMPTS)
+            .select_related("image")
+            .order_by("id")[:batch_size]
+        )
+        if not jobs:
+            return 0
+        sources = [read_source(job.image) for job in jobs]
+        results = (pool.map if pool else map)(try_make_renditions, sources)
+        for job, (made, error) in zip(jobs, results):
+            image = job.image
+            if error:
+                logger.warning(
+                    "Thumbnail of image %d failed: %s", image.id, error
+                )
+                job.attempts += 1
+                job.save(update_fields=["attempts"])
+                continue
+            logger.info(
+                "Generated thumbnail for product %d", image.product_id
+            )
+            thumbnail, renditions = made
+            save_renditions(image, renditions)
+            save_thumbnail(image, thumbnail)
+            image.save(update_fields=["thumbnail"])
+            job.delete()
+    return len(jobs)
+
+
+def save_thumbnail(image, thumbnail):
+    image.thumbnail.save(
+        os.path.basename(image.image.name),
+        ContentFile(thumbnail),
+        save=False,
+    )
+
+
+def rendition_filename(image_name, width, format):
+    root, _ = os.path.splitext(os.path.basename(image_name))
+    return "%s-%d.%s" % (root, width, format)
+
+
+def store_renditions(image, renditions):
+    """Write the files of renditions, returning unsaved rows for them."""
+    objects = []
+    for width, format, data in renditions:
+        rendition = ProductImageRendition(
+            image=image, width=width, format=format
+        )
+        rendition.file.save(
+            rendition_filename(image.image.name, width, format),
+            ContentFile(data),
+            save=False,
+        )
+        objects.append(rendition)
+    return objects
+
+
+def save_renditions(image, renditions):
+    image.renditions.all().delete()
+    ProductImageRendition.objects.bulk_create(
+        store_renditions(image, renditions)
+    )
+
+
+def regenerate(images, pool=None):
+    """
+    Remake the thumbnails and renditions of images, a list, with the
+    map() of pool if given. Images sharing a file are resized once.
+    The rows are written in bulk, without save() signals, so the pages
+    showing the images are expired here. Returns the number of images
+    that failed.
+    """
+    unique = list({image.image.name: image for image in images}.values())
+    sources = [read_source(image) for image in unique]
+    results = dict(
+        zip(
+            (image.image.name for image in unique),
+            (pool.map if pool else map)(try_make_renditions, sources),
+        )
+    )
+    done = []
+    rows = []
+    for image in images:
+        made, error = results[image.image.name]
+        if error:
+            logger.warning(
+                "Thumbnail of image %d failed: %s", image.id, error
+            )
+            continue
+        thumbnail, renditions = made
+        save_thumbnail(image, thumbnail)
+        rows.extend(store_renditions(image, renditions))
+        done.append(image)
+    product_ids = {image.product_id for image in done}
+    with transaction.atomic():
+        ProductImage.objects.bulk_update(done, ["thumbnail"])
+        ProductImageRendition.objects.filter(image__in=done).delete()
+        ProductImageRendition.objects.bulk_create(rows)
+        ThumbnailJob.objects.filter(image__in=done).delete()
+        Product.objects.filter(pk__in=product_ids).update(
+            date_updated=timezone.now()
+        )
+    pagecache.purge(*[pagecache.product_tag(pk) for pk in product_ids])
+    return len(images) - len(done)
+
+
+def reuse_renditions(image):
+    """
+    Give image the thumbnail and renditions of another image with the
+    same file, if one has them. Files are stored by content hash, so
+    equal names mean equal content. Returns whether it did.
+    """
+    source = (
+        ProductImage.objects.filter(image=image.image.name)
+        .exclude(pk=image.pk)
+        .exclude(Q(thumbnail="") | Q(thumbnail__isnull=True))
+        .prefetch_related("renditions")
+        .order_by("id")
+        .first()
+    )
+    if source is None:
+        return False
+    ProductImage.objects.filter(pk=image.pk).update(
+        thumbnail=source.thumbnail.name
+    )
+    image.thumbnail = source.thumbnail.name
+    ProductImageRendition.objects.bulk_create(
+        ProductImageRendition(
+            image=image,
+            width=rendition.width,
+            format=rendition.format,
+            file=rendition.file.name,
+        )
+        for rendition in source.renditions.all()
+    )
+    ThumbnailJob.objects.filter(image=image).delete()
+    return True
+
+
+def srcsets(image):
+    """
+    srcset attribute values of an image, by format. Images without
+    stored renditions yet use the on-demand ones, if their name has
+    the content hash those are looked up by.
+    """
+    by_format = {}
+    for rendition in sorted(image.renditions.all(), key=lambda r: r.width):
+        by_format.setdefault(rendition.format, []).append(
+            "%s %dw" % (rendition.file.url, rendition.width)
+        )
+    if not by_format and on_demand.image_digest(image.image.name):
+        for width in ProductImageRendition.WIDTHS:
+            for format in FORMATS:
+                by_format.setdefault(format, []).append(
+                    "%s %dw"
+                    % (on_demand.url(image.image.name, width, format), width)
+                )
+    return {
+        format: ", ".join(candidates)
+        for format, candidates in by_format.items()
+    }
+
+
+# Names of the images that had a thumbnail when an import started, set
+# in each worker process by the pool initializer
+rendered_images = frozenset()
+
+
+def set_rendered_images(names):
+    global rendered_images
+    rendered_images = frozenset(names)
+
+
+def store_file(model, field_name, filename, data):
+    field = model._meta.get_field(field_name)
+    return media_storage.save(
+        field.generate_filename(None, filename),
+        ContentFile(data),
+        max_length=field.max_length,
+    )
+
+
+def ingest(path, filename):
+    """
+    Store the image file at path and make its thumbnail and renditions,
+    unless they were made for the same file before. Runs in the worker
+    processes of an import, so it only touches storage, never the
+    database.
+
+    Returns the stored names of the image and of its thumbnail, the
+    (width, format, name) renditions and an error. There is no
+    thumbnail if rendering failed or was skipped.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    name = store_file(ProductImage, "image", filename, data)
+    if name in rendered_images:
+        return name, None, [], None
+    made, error = try_make_renditions(data)
+    if error:
+        return name, None, [], error
+    thumbnail, renditions = made
+    return (
+        name,
+        store_file(
+            ProductImage, "thumbnail", os.path.basename(name), thumbnail
+        ),
+        [
+            (
+                width,
+                format,
+                store_file(
+                    ProductImageRendition,
+                    "file",
+                    rendition_filename(name, width, format),
+                    encoded,
+                ),
+            )
+            for width, format, encoded in renditions
+        ],
+        None,
+    )
@@ -1,16 +1,21 @@
-from django.urls import path, include
+from django.urls import path, re_path, include
 from django.views.generic import TemplateView
-from django.views.generic.detail import DetailView
 from django.contrib.auth import views as auth_views
-from main import views, models, forms
+from main import views, forms
 from rest_framework import routers
 from main import endpoints
+from main.pagecache import cache_anonymous_page
 from main import admin
 
 # DRF Endpoints
 router = routers.DefaultRouter()
 router.register(r'orderlines', endpoints.PaidOrderLineViewSet)
 router.register(r'orders', endpoints.PaidOrderViewSet)
+router.register(
+    r'products/search',
+    endpoints.ProductSearchViewSet,
+    basename='product-search',
+)
 
 ###################
 
@@ -72,6 +77,11 @@ urlpatterns = [
         views.add_to_basket,
         name="add_to_basket",
     ),
+    path(
+        "add_to_basket/json/",
+        views.add_to_basket_json,
+        name="add_to_basket_json",
+    ),
     path(
         "login/",
         auth_views.LoginView.as_view(
@@ -82,12 +92,16 @@ urlpatterns = [
     ),
     path(
         "about-us/",
-        TemplateView.as_view(template_name="about_us.html"),
+        cache_anonymous_page(
+            TemplateView.as_view(template_name="about_us.html")
+        ),
         name="about_us",
     ),
     path(
         "",
-        TemplateView.as_view(template_name="home.html"),
+        cache_anonymous_page(
+            TemplateView.as_view(template_name="home.html")
+        ),
         name="home",
     ),
     path(
@@ -97,14 +111,25 @@ urlpatterns = [
     ),
     path(
         "products/<slug:tag>/",
-        views.ProductListView.as_view(),
+        cache_anonymous_page(views.ProductListView.as_view()),
         name="products",
     ),
+    path(
+        "search/",
+        views.ProductSearchView.as_view(),
+        name="product_search",
+    ),
     path(
         "product/<slug:slug>/",
-        DetailView.as_view(model=models.Product),
+        cache_anonymous_page(views.ProductDetailView.as_view()),
         name="product",
     ),
+    re_path(
+        r"^images/(?P<digest>[0-9a-f]{64})/(?P<width>[0-9]+)"
+        r"\.(?P<format>webp|jpeg)$",
+        views.image_rendition,
+        name="image_rendition",
+    ),
     path(
         "basket/",
         views.manage_basket,
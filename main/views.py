@@ -1,8 +1,14 @@
+from django.core.cache import cache
+from django.templatetags.static import static
 from django.shortcuts import render
-from main import forms
+from main import catalog, forms, pagecache, renditions, thumbnails
+from django.views.generic.detail import DetailView
 from django.views.generic.list import ListView
 from django.shortcuts import get_object_or_404
 from main import models
+from main.baskets import SessionBasket
+from main.conditional import ConditionalGetMixin, make_etag, page_state
+from main.search import format_headline
 import logging
 from django.contrib.auth import login, authenticate
 from django.contrib import messages
@@ -17,7 +23,11 @@ import django_filters
 from django_filters.views import FilterView
 # Todo: implement tempaltes
 from django.views.generic.edit import FormView, CreateView, UpdateView, DeleteView
-from django.http import HttpResponseRedirect
+from django.http import (
+    FileResponse, Http404, HttpResponseRedirect, JsonResponse
+)
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import require_GET, require_POST
 from django.urls import reverse
 from django.views.generic.edit import (
     FormView,
@@ -26,26 +36,156 @@ from django.views.generic.edit import (
     DeleteView,
 )
 
+PRODUCT_IMAGES_TIMEOUT = 60 * 60 * 24
+
+RENDITION_MAX_AGE = 60 * 60 * 24 * 365
+
 
-class ProductListView(ListView):
+class ProductListView(ConditionalGetMixin, pagecache.PageTagsMixin, ListView):
     template_name = "main/product_list.html"
     paginate_by = 4
 
-    def get_queryset(self):
+    def get_validators(self):
+        # The catalog receivers move the date of a list whenever one of
+        # its products is saved, so no query is needed.
         tag = self.kwargs['tag']
-        self.tag = None
-        if tag != "all":
-            self.tag = get_object_or_404(
-                models.ProductTag, slug=tag
-            )
-        if self.tag:
-            products = models.Product.objects.active().filter(
-                tags=self.tag
-            )
-        else:
-            products = models.Product.objects.active()
+        listing = catalog.get_listing(tag)
+        if listing is None:
+            return None, None
+        updated, entries = listing
+        etag = make_etag(
+            tag, updated, len(entries), page_state(self.request)
+        )
+        return etag, updated
 
-        return products.order_by("name")
+    def get_queryset(self):
+        # Ordered product ids come from the catalog cache, and only the
+        # rows of the requested page are loaded in paginate_queryset.
+        self.entries = catalog.get_entries(self.kwargs['tag'])
+        if self.entries is None:
+            raise Http404("No such tag")
+        return models.Product.objects.none()
+
+    def get_page_tags(self, context):
+        return [pagecache.catalog_tag(self.kwargs['tag'])]
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = catalog.CatalogPaginator(self.entries, page_size)
+        try:
+            page = paginator.page(self.request.GET.get("cursor"))
+        except ValueError:
+            raise Http404("Invalid cursor")
+        return paginator, page, page.object_list, page.has_other_pages()
+
+
+class ProductDetailView(ConditionalGetMixin, pagecache.PageTagsMixin, DetailView):
+    model = models.Product
+
+    def get_validators(self):
+        product = self.get_product_queryset().values_list(
+            "id", "date_updated"
+        ).first()
+        if product is None:
+            return None, None
+        return make_etag(product, page_state(self.request)), product[1]
+
+    def get_product_queryset(self):
+        # Slugs are not unique: active products win, then the oldest
+        return models.Product.objects.filter(
+            slug=self.kwargs["slug"]
+        ).order_by("-active", "id")
+
+    def get_object(self, queryset=None):
+        product = (
+            self.get_product_queryset().prefetch_related("tags").first()
+        )
+        if product is None:
+            raise Http404("No product found")
+        return product
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["images"] = self.get_images()
+        context["recommendations"] = (
+            models.Recommendation.objects.for_product(self.object)
+        )
+        return context
+
+    def get_page_tags(self, context):
+        product = context["object"]
+        return [
+            pagecache.product_tag(product.id),
+            pagecache.product_slug_tag(self.kwargs["slug"]),
+            *[pagecache.tag_tag(tag.slug) for tag in product.tags.all()],
+        ]
+
+    def get_images(self):
+        # Saving or deleting an image touches the product, which
+        # moves date_updated and so the cache key.
+        product = self.object
+        key = "product-images:%d:%s" % (
+            product.id, product.date_updated.isoformat()
+        )
+        images = cache.get(key)
+        if images is None:
+            images = []
+            for image in product.productimage_set.prefetch_related(
+                "renditions"
+            ).order_by("id"):
+                srcsets = thumbnails.srcsets(image)
+                images.append(
+                    {
+                        "image": image.image.url,
+                        "thumbnail": (
+                            image.thumbnail.url
+                            if image.thumbnail
+                            else static(thumbnails.PLACEHOLDER)
+                        ),
+                        "srcset": srcsets.get(
+                            models.ProductImageRendition.JPEG, ""
+                        ),
+                        "webp_srcset": srcsets.get(
+                            models.ProductImageRendition.WEBP, ""
+                        ),
+                    }
+                )
+            cache.set(key, images, PRODUCT_IMAGES_TIMEOUT)
+        return images
+
+
+@require_GET
+def image_rendition(request, digest, width, format):
+    # The URL names the image by content hash, so a response never
+    # goes stale and can be cached by browsers for good.
+    width = int(width)
+    if not renditions.is_valid(width, format):
+        raise Http404("No such rendition")
+    f = renditions.get_rendition(digest, width, format)
+    if f is None:
+        raise Http404("No such image")
+    response = FileResponse(f, content_type=renditions.CONTENT_TYPES[format])
+    patch_cache_control(
+        response, public=True, max_age=RENDITION_MAX_AGE, immutable=True
+    )
+    return response
+
+
+class ProductSearchView(ListView):
+    template_name = "main/product_search.html"
+    paginate_by = 10
+
+    def get_queryset(self):
+        self.query = self.request.GET.get("q", "").strip()
+        if not self.query:
+            return models.Product.objects.none()
+        return models.Product.objects.search(self.query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        for product in context["object_list"]:
+            product.snippet = format_headline(product.headline)
+        return context
 
 
 class ContactUsView(FormView):
@@ -139,42 +279,70 @@ class AddressDeleteView(LoginRequiredMixin, DeleteView):
         return self.model.objects.filter(user=self.request.user)
 
 
-def add_to_basket(request):
-    product = get_object_or_404(
-        models.Product, pk=request.GET.get("product_id")
-    )
+def get_or_create_basket(request):
     basket = request.basket
-    if not request.basket:
+    if not basket:
         if request.user.is_authenticated:
-            user = request.user
+            basket = models.Basket.objects.create(user=request.user)
+            request.session['basket_id'] = basket.id
         else:
-            user = None
-        basket = models.Basket.objects.create(user=user)
-        request.session['basket_id'] = basket.id
+            basket = SessionBasket(request.session)
+        request.basket = basket
+    return basket
 
-    basketline, created = models.BasketLine.objects.get_or_create(
-        basket=basket, product=product
+
+def add_to_basket(request):
+    product = get_object_or_404(
+        models.Product, pk=request.GET.get("product_id")
     )
-    if not created:
-        basketline.quantity += 1
-        basketline.save()
+    basket = get_or_create_basket(request)
+    basket.add_product(product)
     return HttpResponseRedirect(
         reverse("product", args=(product.slug,))
     )
 
 
+@require_POST
+def add_to_basket_json(request):
+    form = forms.AddToBasketForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({"errors": form.errors}, status=400)
+    product = form.cleaned_data["product"]
+    basket = get_or_create_basket(request)
+    line = basket.add_product(
+        product, form.cleaned_data["quantity"] or 1
+    )
+    return JsonResponse(
+        {
+            "line": {
+                "id": line.id,
+                "product": product.id,
+                "quantity": line.quantity,
+            },
+            "basket": {
+                "id": basket.id,
+                "count": basket.item_count,
+            },
+        }
+    )
+
+
 def manage_basket(request):
     if not request.basket:
         return render(request, "basket.html", {"formset": None})
 
+    if isinstance(request.basket, SessionBasket):
+        formset_class = forms.SessionBasketLineFormSet
+    else:
+        formset_class = forms.BasketLineFormSet
     if request.method == "POST":
-        formset = forms.BasketLineFormSet(
+        formset = formset_class(
             request.POST, instance=request.basket
         )
         if formset.is_valid():
             formset.save()
     else:
-        formset = forms.BasketLineFormSet(
+        formset = formset_class(
             instance=request.basket
         )
     if request.basket.is_empty():
@@ -194,8 +362,10 @@ class AddressSelectionView(LoginRequiredMixin, FormView):
         return kwargs
 
     def form_valid(self, form):
-        del self.request.session['basket_id']
         basket = self.request.basket
+        if isinstance(basket, SessionBasket):
+            basket = basket.save_to_db(self.request.user)
+        del self.request.session['basket_id']
         basket.create_order(
             form.cleaned_data['billing_address'],
             form.cleaned_data['shipping_address']